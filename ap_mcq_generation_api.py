@@ -1,13 +1,27 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Type, Callable, Awaitable, AsyncIterator, Tuple
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 import json
+import os
+import asyncio
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+import uuid
 import requests
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import random
-from openai import OpenAI
+import re
+from collections import Counter, OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager
+from contextvars import ContextVar
+import openai
+from openai import AsyncOpenAI
 
 app = FastAPI()
 # Add CORS middleware
@@ -19,21 +33,965 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-OPENAI_API_KEY = ""
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+# Any OpenAI-compatible chat completions endpoint, e.g. the local mock in
+# benchmarks/mock_llm_server.py; unset uses the OpenAI API (or OPENAI_BASE_URL)
+LLM_BASE_URL = os.getenv("LLM_BASE_URL") or None
 
-def call_openai_api(messages: List[Dict[str, str]]) -> str:
+def create_llm_client(base_url: Optional[str] = LLM_BASE_URL,
+                      api_key: str = OPENAI_API_KEY) -> AsyncOpenAI:
+    """Client for the LLM backend. Retries are handled by call_llm_json so
+    that rate limits reach the controller."""
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+
+openai_client = create_llm_client()
+
+# Process-wide window of in-flight OpenAI calls, shared by every request and
+# adjusted between the min and max with AIMD (see AdaptiveConcurrencyController)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_MIN_CONCURRENCY = int(os.getenv("LLM_MIN_CONCURRENCY", "1"))
+LLM_INITIAL_CONCURRENCY = int(os.getenv("LLM_INITIAL_CONCURRENCY", "8"))
+LLM_DECREASE_FACTOR = 0.5
+# Stop growing the window when less than this share of the rate limit is left
+LLM_RATE_LIMIT_HEADROOM = 0.1
+# Stop growing the window when recent latency rises this far above the long-run level
+LLM_LATENCY_TOLERANCE = 2.0
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Seconds to wait from Retry-After / retry-after-ms response headers"""
+    if headers is None:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return None
+
+def rate_limit_headroom(headers) -> Optional[float]:
+    """Smallest remaining/limit ratio of the x-ratelimit request and token headers"""
+    if headers is None:
+        return None
+    ratios = []
+    for kind in ("requests", "tokens"):
+        try:
+            remaining = float(headers.get(f"x-ratelimit-remaining-{kind}"))
+            limit = float(headers.get(f"x-ratelimit-limit-{kind}"))
+        except (TypeError, ValueError):
+            continue
+        if limit > 0:
+            ratios.append(remaining / limit)
+    return min(ratios) if ratios else None
+
+# Identifies the request an LLM call belongs to, for fair queueing
+current_llm_flow: ContextVar[Optional[str]] = ContextVar("current_llm_flow", default=None)
+
+class AdaptiveConcurrencyController:
+    """AIMD limit on in-flight OpenAI calls with fair queueing across requests.
+
+    Each success grows the window by 1/window (about +1 per window of
+    calls) unless the upstream looks saturated: recent latency well above
+    its long-run level, or little rate-limit headroom left. A rate limit halves it and, with Retry-After, pauses new calls;
+    timeouts and server errors halve it as well. Waiting calls are queued per
+    request and granted round-robin, so one large bank cannot starve others.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.latency_ewma: Optional[float] = None  # recent calls
+        self.baseline_latency_ewma: Optional[float] = None  # long run
+        self.last_decrease = 0.0
+        self.counters = {"successes": 0, "rate_limited": 0, "overloaded": 0}
+        self._queues: "OrderedDict[Optional[str], deque]" = OrderedDict()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < max(self.minimum, int(self.window))
+
+    def _dispatch(self):
+        """Grant free slots to queued calls, one flow at a time"""
+        while self._queues and self._has_capacity():
+            flow, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(flow)
+            else:
+                del self._queues[flow]
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self):
+        if not self._queues and self._has_capacity():
+            self.in_flight += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(current_llm_flow.get(), deque()).append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Slot was granted just as we were cancelled: hand it on
+                    self.release()
+                raise
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                # The caller's try/finally release() has not started yet
+                self.release()
+                raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _decrease(self):
+        # One decrease per burst: calls already in flight fail together
+        now = time.monotonic()
+        if now - self.last_decrease >= 1.0:
+            self.window = max(self.minimum, self.window * LLM_DECREASE_FACTOR)
+            self.last_decrease = now
+
+    def on_success(self, latency: float, headers=None):
+        self.counters["successes"] += 1
+        if self.latency_ewma is None:
+            self.latency_ewma = self.baseline_latency_ewma = latency
+        else:
+            self.latency_ewma = 0.7 * self.latency_ewma + 0.3 * latency
+            self.baseline_latency_ewma = 0.98 * self.baseline_latency_ewma + 0.02 * latency
+        headroom = rate_limit_headroom(headers)
+        saturated = (headroom is not None and headroom < LLM_RATE_LIMIT_HEADROOM) or (
+            self.latency_ewma > LLM_LATENCY_TOLERANCE * self.baseline_latency_ewma)
+        if not saturated:
+            self.window = min(self.maximum, self.window + 1.0 / self.window)
+        self._dispatch()
+
+    def on_rate_limit(self, headers=None):
+        self.counters["rate_limited"] += 1
+        self._decrease()
+        retry_after = parse_retry_after(headers)
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def on_overload(self):
+        self.counters["overloaded"] += 1
+        self._decrease()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window": round(self.window, 2),
+            "min_window": self.minimum,
+            "max_window": self.maximum,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "queued_flows": len(self._queues),
+            "paused_for_seconds": round(max(0.0, self.paused_until - time.monotonic()), 2),
+            "latency_ewma_seconds": self.latency_ewma and round(self.latency_ewma, 3),
+            "baseline_latency_ewma_seconds": (self.baseline_latency_ewma
+                                              and round(self.baseline_latency_ewma, 3)),
+            **self.counters,
+        }
+
+llm_controller = AdaptiveConcurrencyController(
+    LLM_INITIAL_CONCURRENCY, LLM_MIN_CONCURRENCY, LLM_MAX_CONCURRENCY)
+
+LLM_MODEL = "o3-mini"
+LLM_REASONING_EFFORT = "high"
+
+# Model tiers, cheapest first, as tier name -> (model, reasoning effort).
+# LLM_TIERS='{"low": ["o3-mini", "low"], ...}' replaces the whole table.
+LLM_TIERS: Dict[str, Tuple[str, str]] = {
+    name: tuple(tier) for name, tier in json.loads(os.getenv("LLM_TIERS", json.dumps({
+        "low": [LLM_MODEL, "low"],
+        "medium": [LLM_MODEL, "medium"],
+        "high": [LLM_MODEL, LLM_REASONING_EFFORT],
+    }))).items()}
+LLM_TIER_ORDER = list(LLM_TIERS)
+
+# Starting tier per stage for difficulty 1, 2 and 3. Output that fails
+# validation is retried one tier up. LLM_STAGE_TIERS overrides single stages,
+# e.g. '{"explanations": ["medium", "medium", "high"]}'. With LLM_TIERING=0
+# every call uses the highest tier.
+LLM_TIERING = os.getenv("LLM_TIERING", "1").lower() in ("1", "true", "yes", "on")
+LLM_STAGE_TIERS: Dict[str, List[str]] = {
+    "question_set": ["medium", "high", "high"],
+    "correct_answer": ["low", "medium", "high"],
+    "distractors": ["medium", "medium", "high"],
+    "distractor_repair": ["medium", "medium", "high"],
+    "explanations": ["low", "medium", "high"],
+    "fused": ["medium", "high", "high"],
+    **json.loads(os.getenv("LLM_STAGE_TIERS", "{}")),
+}
+
+for _stage, _tiers in LLM_STAGE_TIERS.items():
+    if len(_tiers) != 3 or any(t not in LLM_TIERS for t in _tiers):
+        raise ValueError(f"LLM_STAGE_TIERS[{_stage!r}] must name 3 tiers from "
+                         f"{LLM_TIER_ORDER}, got {_tiers!r}")
+
+def select_tier(stage: str, difficulty: Optional[int] = None, escalation: int = 0) -> str:
+    """Tier for a call: the stage's tier at this difficulty, escalation steps up"""
+    top = len(LLM_TIER_ORDER) - 1
+    if not LLM_TIERING or stage not in LLM_STAGE_TIERS:
+        return LLM_TIER_ORDER[top]
+    tiers = LLM_STAGE_TIERS[stage]
+    base = tiers[min(max(difficulty or 3, 1), 3) - 1]
+    return LLM_TIER_ORDER[min(LLM_TIER_ORDER.index(base) + escalation, top)]
+
+# LLM response cache. Modes:
+#   off       - always call the API
+#   readwrite - serve unexpired hits, store every fresh response
+#   record    - always call the API and store every response
+#   replay    - serve only stored responses (ignoring TTL); a miss is an error
+LLM_CACHE_MODES = ("off", "readwrite", "record", "replay")
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "readwrite")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+LLM_CACHE_MEMORY_ITEMS = int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "512"))
+LLM_CACHE_DISK_ITEMS = int(os.getenv("LLM_CACHE_DISK_ITEMS", "50000"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "86400"))
+# How long a cache read or write waits for another process's lock (batch
+# workers share the file) before giving up on the disk tier for that call
+LLM_CACHE_BUSY_TIMEOUT = float(os.getenv("LLM_CACHE_BUSY_TIMEOUT", "5"))
+
+if LLM_CACHE_MODE not in LLM_CACHE_MODES:
+    raise ValueError(f"LLM_CACHE_MODE must be one of {LLM_CACHE_MODES}, got {LLM_CACHE_MODE!r}")
+
+class LLMResponseCache:
+    """Content-addressed LLM response cache: in-memory LRU in front of SQLite.
+
+    The cache is best-effort: a SQLite error (e.g. the file locked by other
+    processes) is logged and counted, and the lookup is treated as a miss or
+    the write skipped. If the database cannot be opened at all, only the
+    memory tier is used.
+    """
+
+    def __init__(self, path: str, memory_items: int, disk_items: int,
+                 ttl_seconds: float, busy_timeout: float = LLM_CACHE_BUSY_TIMEOUT):
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "writes": 0,
+            "evictions": 0,
+            "disk_errors": 0,
+        }
+        self._conn: Optional[sqlite3.Connection] = None
+        try:
+            conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+            # WAL lets readers in other processes run alongside a writer
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS llm_cache (
+                       key TEXT PRIMARY KEY,
+                       response TEXT NOT NULL,
+                       created_at REAL NOT NULL,
+                       last_access REAL NOT NULL)""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache (last_access)")
+            conn.commit()
+            self._conn = conn
+        except sqlite3.Error as e:
+            self._disk_error("open", e)
+
+    def _disk_error(self, operation: str, error: sqlite3.Error):
+        """Log a SQLite error and carry on without the disk tier for this call"""
+        self.counters["disk_errors"] += 1
+        print(f"LLM cache {operation} failed, continuing without the disk cache: {str(error)}")
+        if self._conn is not None:
+            try:
+                self._conn.rollback()
+            except sqlite3.Error:
+                pass
+
+    @staticmethod
+    def make_key(model: str, reasoning_effort: str,
+                 messages: List[Dict[str, str]]) -> str:
+        """Hash of everything that determines the model output"""
+        payload = json.dumps(
+            {"model": model, "reasoning_effort": reasoning_effort, "messages": messages},
+            sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.ttl_seconds > 0 and time.time() - created_at > self.ttl_seconds
+
+    def _remember(self, key: str, response: str, created_at: float):
+        self._memory[key] = (response, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str, ignore_ttl: bool = False) -> Optional[str]:
+        """Look up a response, checking memory first and then disk"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                response, created_at = entry
+                if ignore_ttl or not self._is_expired(created_at):
+                    self._memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return response
+                del self._memory[key]
+
+            if self._conn is not None:
+                try:
+                    response = self._get_disk(key, ignore_ttl)
+                except sqlite3.Error as e:
+                    self._disk_error("read", e)
+                    response = None
+                if response is not None:
+                    return response
+
+            self.counters["misses"] += 1
+            return None
+
+    def _get_disk(self, key: str, ignore_ttl: bool) -> Optional[str]:
+        row = self._conn.execute(
+            "SELECT response, created_at FROM llm_cache WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+        response, created_at = row
+        if ignore_ttl or not self._is_expired(created_at):
+            self._conn.execute(
+                "UPDATE llm_cache SET last_access = ? WHERE key = ?",
+                (time.time(), key))
+            self._conn.commit()
+            self._remember(key, response, created_at)
+            self.counters["disk_hits"] += 1
+            return response
+        self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+        self._conn.commit()
+        self.counters["expired"] += 1
+        return None
+
+    def put(self, key: str, response: str):
+        """Store a response in both tiers, evicting least recently used rows"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            self.counters["writes"] += 1
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, response, created_at, last_access) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, response, now, now))
+                (count,) = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+                overflow = count - self.disk_items
+                if overflow > 0:
+                    self._conn.execute(
+                        "DELETE FROM llm_cache WHERE key IN "
+                        "(SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                        (overflow,))
+                    self.counters["evictions"] += overflow
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._disk_error("write", e)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            disk_items = None
+            if self._conn is not None:
+                try:
+                    (disk_items,) = self._conn.execute(
+                        "SELECT COUNT(*) FROM llm_cache").fetchone()
+                except sqlite3.Error as e:
+                    self._disk_error("count", e)
+            stats = dict(self.counters)
+            stats["memory_items"] = len(self._memory)
+            stats["disk_items"] = disk_items
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+# Opened on first use so that importing the module creates no files
+llm_cache: Optional[LLMResponseCache] = None
+llm_cache_lock = threading.Lock()
+
+def get_llm_cache() -> Optional[LLMResponseCache]:
+    """The process-wide LLM response cache, or None when LLM_CACHE_MODE is off"""
+    global llm_cache
+    if LLM_CACHE_MODE == "off":
+        return None
+    with llm_cache_lock:
+        if llm_cache is None:
+            llm_cache = LLMResponseCache(LLM_CACHE_PATH, LLM_CACHE_MEMORY_ITEMS,
+                                         LLM_CACHE_DISK_ITEMS, LLM_CACHE_TTL_SECONDS)
+    return llm_cache
+
+# Set for explicit regeneration (e.g. /edit-question): calls skip cache reads
+# so that asking again gets a new answer; responses are still written
+current_llm_cache_bypass: ContextVar[bool] = ContextVar("current_llm_cache_bypass",
+                                                        default=False)
+
+# "staged": separate correct answer, distractor and explanation calls per question.
+# "fused": one call per question for all three, falling back to staged on failure.
+GENERATION_MODES = ("staged", "fused")
+GENERATION_MODE = os.getenv("GENERATION_MODE", "staged")
+
+if GENERATION_MODE not in GENERATION_MODES:
+    raise ValueError(f"GENERATION_MODE must be one of {GENERATION_MODES}, got {GENERATION_MODE!r}")
+
+# Retry policy. A call is attempted up to LLM_MAX_ATTEMPTS times; every retry
+# and every regenerated question chain spends one unit of the bank's budget.
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "20.0"))
+BANK_RETRY_BUDGET = int(os.getenv("BANK_RETRY_BUDGET", "10"))
+
+# OpenAI errors worth retrying: rate limits, timeouts, dropped connections, 5xx
+RETRYABLE_OPENAI_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+class LLMCallError(HTTPException):
+    """An OpenAI call failed; retryable says whether trying again may succeed"""
+
+    def __init__(self, detail: str, retryable: bool):
+        super().__init__(status_code=500, detail=detail)
+        self.retryable = retryable
+
+class RetryBudget:
+    """Number of retries a single question bank may spend before it fails"""
+
+    def __init__(self, retries: int):
+        self.remaining = retries
+
+    def take(self) -> bool:
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+current_retry_budget: ContextVar[Optional[RetryBudget]] = ContextVar(
+    "current_retry_budget", default=None)
+
+def take_retry() -> bool:
+    """Spend one retry from the current bank's budget, if it has one left"""
+    budget = current_retry_budget.get()
+    return budget is None or budget.take()
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY,
+                                 LLM_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+# Optional gate awaited before every OpenAI call: any object with an async
+# acquire() method, e.g. the cross-process rate limiter in batch_generate.py
+llm_rate_limiter = None
+
+# Prometheus metrics, served in the text exposition format by GET /metrics
+METRIC_LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+class MetricsRegistry:
+    """Minimal in-process Prometheus counters, gauges and histograms"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self._values: Dict[str, Dict[Tuple, Any]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+        self._values.setdefault(name, {})
+
+    @staticmethod
+    def _key(labels: Optional[Dict[str, Any]]) -> Tuple:
+        return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+    def inc(self, name: str, labels: Optional[Dict[str, Any]] = None, value: float = 1.0):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0.0) + value
+
+    def set(self, name: str, labels: Optional[Dict[str, Any]], value: float):
+        with self._lock:
+            self._values[name][self._key(labels)] = float(value)
+
+    def observe(self, name: str, labels: Optional[Dict[str, Any]], value: float):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values[name]
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = {"buckets": [0] * len(METRIC_LATENCY_BUCKETS),
+                                      "sum": 0.0, "count": 0}
+            for i, bound in enumerate(METRIC_LATENCY_BUCKETS):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    @staticmethod
+    def _format_value(value: float) -> str:
+        """Counts as ints, anything else at full float precision"""
+        if isinstance(value, int) or float(value).is_integer():
+            return str(int(value))
+        return repr(float(value))
+
+    @staticmethod
+    def _format_labels(key: Tuple, extra: Tuple = ()) -> str:
+        pairs = key + extra
+        if not pairs:
+            return ""
+        return "{" + ",".join(
+            f'{k}="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+            for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in self._meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in self._values[name].items():
+                    if kind != "histogram":
+                        lines.append(f"{name}{self._format_labels(key)} {self._format_value(value)}")
+                        continue
+                    for bound, count in zip(METRIC_LATENCY_BUCKETS, value["buckets"]):
+                        lines.append(f"{name}_bucket"
+                                     f"{self._format_labels(key, (('le', f'{bound:g}'),))} {count}")
+                    lines.append(f"{name}_bucket"
+                                 f"{self._format_labels(key, (('le', '+Inf'),))} {value['count']}")
+                    lines.append(f"{name}_sum{self._format_labels(key)} {self._format_value(value['sum'])}")
+                    lines.append(f"{name}_count{self._format_labels(key)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("mcq_llm_calls_total", "counter",
+                 "OpenAI calls by stage, difficulty, tier and outcome")
+metrics.describe("mcq_llm_call_seconds", "histogram",
+                 "Latency of successful OpenAI calls")
+metrics.describe("mcq_llm_tokens_total", "counter",
+                 "Tokens reported by OpenAI usage, by kind (prompt, cached_prompt, "
+                 "uncached_prompt, completion, reasoning)")
+metrics.describe("mcq_llm_retries_total", "counter",
+                 "OpenAI calls retried, by reason")
+metrics.describe("mcq_llm_failures_total", "counter",
+                 "LLM calls that failed after all attempts")
+metrics.describe("mcq_missing_questions_total", "counter",
+                 "Requested questions missing from returned banks, by difficulty")
+metrics.describe("mcq_chain_regenerations_total", "counter",
+                 "Question chains regenerated after a failure")
+metrics.describe("mcq_article_tokens_total", "counter",
+                 "Estimated article tokens in per-question prompts, by kind (full: "
+                 "whole article, sent: retrieved passages actually sent)")
+metrics.describe("mcq_stage_seconds", "histogram",
+                 "Wall time of a pipeline stage for one question (or question set)")
+metrics.describe("mcq_requests_total", "counter",
+                 "Question bank requests by endpoint and status")
+metrics.describe("mcq_request_seconds", "histogram",
+                 "Wall time of a question bank request")
+metrics.describe("mcq_coalesced_requests_total", "counter",
+                 "Requests served by a pipeline run already started for an identical request")
+metrics.describe("mcq_shared_generations", "gauge",
+                 "Pipeline runs that identical requests can attach to, running or completed")
+metrics.describe("mcq_llm_concurrency_window", "gauge",
+                 "Current adaptive concurrency window")
+metrics.describe("mcq_llm_in_flight", "gauge", "OpenAI calls in flight")
+metrics.describe("mcq_llm_queue_depth", "gauge", "OpenAI calls waiting for a slot")
+metrics.describe("mcq_llm_hedges_total", "counter", "Hedged duplicate OpenAI calls sent")
+metrics.describe("mcq_llm_cache_lookups_total", "counter",
+                 "LLM cache lookups by result")
+
+def metric_labels(stage: str, difficulty: Optional[int], **extra) -> Dict[str, Any]:
+    return {"stage": stage, "difficulty": difficulty if difficulty is not None else "any",
+            **extra}
+
+def usage_tokens(usage) -> Dict[str, int]:
+    """Token counts from an OpenAI usage object (missing fields count as 0)"""
+    if usage is None:
+        return {}
+    details = getattr(usage, "completion_tokens_details", None)
+    prompt = getattr(usage, "prompt_tokens", 0) or 0
+    # Prompt tokens served from the provider's prefix cache
+    cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", 0) or 0
+    return {
+        "prompt": prompt,
+        "cached_prompt": cached,
+        "uncached_prompt": prompt - cached,
+        "completion": getattr(usage, "completion_tokens", 0) or 0,
+        "reasoning": getattr(details, "reasoning_tokens", 0) or 0,
+    }
+
+class RequestTimings:
+    """Per-request breakdown of wall time, LLM time, calls and tokens by stage"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.retrieval: Optional[Dict[str, int]] = None
+
+    def _stage(self, stage: str) -> Dict[str, float]:
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = {
+                "wall_seconds": 0.0, "llm_seconds": 0.0, "calls": 0, "retries": 0,
+                "prompt_tokens": 0, "cached_prompt_tokens": 0, "uncached_prompt_tokens": 0,
+                "completion_tokens": 0, "reasoning_tokens": 0}
+        return entry
+
+    def record_stage(self, stage: str, seconds: float):
+        self._stage(stage)["wall_seconds"] += seconds
+
+    def record_call(self, stage: str, seconds: float, tokens: Dict[str, int]):
+        entry = self._stage(stage)
+        entry["llm_seconds"] += seconds
+        entry["calls"] += 1
+        for kind, count in tokens.items():
+            entry[f"{kind}_tokens"] += count
+
+    def record_retry(self, stage: str):
+        self._stage(stage)["retries"] += 1
+
+    def record_retrieval(self, retrieval: Dict[str, int]):
+        """Article tokens per-question prompts would have sent vs. actually sent"""
+        self.retrieval = retrieval
+
+    def summary(self) -> Dict[str, Any]:
+        summary = {
+            "total_seconds": round(time.monotonic() - self.started, 3),
+            "stages": {
+                stage: {k: round(v, 3) if isinstance(v, float) else v
+                        for k, v in entry.items()}
+                for stage, entry in self.stages.items()
+            },
+        }
+        if self.retrieval is not None:
+            summary["retrieval"] = self.retrieval
+        return summary
+
+    def server_timing(self) -> str:
+        """Server-Timing header value in ms: total, then per stage its wall time
+        summed over questions (LLM time for stages that run inside another)"""
+        parts = [f"total;dur={(time.monotonic() - self.started) * 1000:.0f}"]
+        for stage, entry in self.stages.items():
+            seconds = entry["wall_seconds"] or entry["llm_seconds"]
+            parts.append(f"{stage};dur={seconds * 1000:.0f}"
+                         f";desc=\"{entry['calls']} calls\"")
+        return ", ".join(parts)
+
+current_request_timings: ContextVar[Optional[RequestTimings]] = ContextVar(
+    "current_request_timings", default=None)
+
+# Hedged requests (opt-in). Once a call has run longer than
+# LLM_HEDGE_PERCENTILE of recent latencies for its stage, a duplicate is sent
+# and the first usable response wins. Hedges are capped at LLM_HEDGE_MAX_RATIO
+# of primary calls and LLM_HEDGE_MAX_IN_FLIGHT at a time.
+LLM_HEDGING = os.getenv("LLM_HEDGING", "0").lower() in ("1", "true", "yes", "on")
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_MAX_RATIO = float(os.getenv("LLM_HEDGE_MAX_RATIO", "0.05"))
+LLM_HEDGE_MAX_IN_FLIGHT = int(os.getenv("LLM_HEDGE_MAX_IN_FLIGHT", "2"))
+LLM_LATENCY_WINDOW = 200
+
+class StageLatencyTracker:
+    """Rolling window of successful OpenAI call latencies per pipeline stage"""
+
+    def __init__(self, window: int):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+
+    def record(self, stage: str, latency: float):
+        samples = self._samples.get(stage)
+        if samples is None:
+            samples = self._samples[stage] = deque(maxlen=self.window)
+        samples.append(latency)
+
+    def percentile(self, stage: str, pct: float,
+                   min_samples: int = 1) -> Optional[float]:
+        """Nearest-rank percentile, or None with fewer than min_samples"""
+        samples = self._samples.get(stage)
+        if not samples or len(samples) < max(1, min_samples):
+            return None
+        ordered = sorted(samples)
+        rank = math.ceil(pct / 100 * len(ordered))
+        return ordered[max(0, min(rank, len(ordered)) - 1)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            stage: {
+                "samples": len(samples),
+                **{f"p{pct}_seconds": round(self.percentile(stage, pct), 3)
+                   for pct in (50, 90, 99)},
+            }
+            for stage, samples in self._samples.items()
+        }
+
+class HedgeBudget:
+    """Token bucket bounding hedged calls to a share of primary calls"""
+
+    def __init__(self, ratio: float, max_in_flight: int):
+        self.ratio = ratio
+        self.max_in_flight = max_in_flight
+        self.capacity = float(max(1, max_in_flight))
+        self.tokens = 0.0
+        self.in_flight = 0
+        self.counters = {"primary_calls": 0, "hedges": 0, "hedge_wins": 0,
+                         "hedges_skipped": 0}
+
+    def on_primary(self):
+        self.counters["primary_calls"] += 1
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def take(self) -> bool:
+        if self.tokens < 1 or self.in_flight >= self.max_in_flight:
+            self.counters["hedges_skipped"] += 1
+            return False
+        self.tokens -= 1
+        self.in_flight += 1
+        self.counters["hedges"] += 1
+        return True
+
+    def done(self, won: bool):
+        self.in_flight -= 1
+        if won:
+            self.counters["hedge_wins"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": LLM_HEDGING, "percentile": LLM_HEDGE_PERCENTILE,
+                "tokens": round(self.tokens, 2), "in_flight": self.in_flight,
+                **self.counters}
+
+stage_latencies = StageLatencyTracker(LLM_LATENCY_WINDOW)
+hedge_budget = HedgeBudget(LLM_HEDGE_MAX_RATIO, LLM_HEDGE_MAX_IN_FLIGHT)
+
+async def call_openai_api(messages: List[Dict[str, str]],
+                          model: str = LLM_MODEL,
+                          reasoning_effort: str = LLM_REASONING_EFFORT,
+                          stage: str = "unknown",
+                          difficulty: Optional[int] = None,
+                          tier: str = "") -> str:
     """Make API call to OpenAI"""
+    labels = metric_labels(stage, difficulty, tier=tier)
+    outcome = "error"
     try:
-        response = openai_client.chat.completions.create(
-            model="o3-mini",
-            messages=messages,
-            reasoning_effort="high"
-        )
+        await llm_controller.acquire()
+        try:
+            if llm_rate_limiter is not None:
+                await llm_rate_limiter.acquire()
+            started = time.monotonic()
+            raw = await openai_client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=messages,
+                reasoning_effort=reasoning_effort
+            )
+            response = raw.parse()
+            latency = time.monotonic() - started
+            outcome = "success"
+            llm_controller.on_success(latency, raw.headers)
+            stage_latencies.record(f"{stage}@{tier}" if tier else stage, latency)
+            tokens = usage_tokens(response.usage)
+            metrics.observe("mcq_llm_call_seconds", labels, latency)
+            for kind, count in tokens.items():
+                metrics.inc("mcq_llm_tokens_total", {**labels, "kind": kind}, count)
+            timings = current_request_timings.get()
+            if timings is not None:
+                timings.record_call(stage, latency, tokens)
+        except openai.RateLimitError as e:
+            outcome = "rate_limited"
+            llm_controller.on_rate_limit(e.response.headers)
+            raise
+        except RETRYABLE_OPENAI_ERRORS:
+            outcome = "overloaded"
+            llm_controller.on_overload()
+            raise
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            llm_controller.release()
         return response.choices[0].message.content
     except Exception as e:
-        raise HTTPException(status_code=500, 
-                          detail=f"Error calling OpenAI API: {str(e)}")
+        raise LLMCallError(f"Error calling OpenAI API: {str(e)}",
+                           retryable=isinstance(e, RETRYABLE_OPENAI_ERRORS))
+    finally:
+        metrics.inc("mcq_llm_calls_total", {**labels, "outcome": outcome})
+
+async def call_openai_hedged(messages: List[Dict[str, str]],
+                             model: str = LLM_MODEL,
+                             reasoning_effort: str = LLM_REASONING_EFFORT,
+                             stage: str = "unknown",
+                             difficulty: Optional[int] = None,
+                             tier: str = "") -> str:
+    """call_openai_api, plus a duplicate request if the first one straggles.
+
+    The hedge is only sent when the stage has enough latency history, no
+    calls are queued for the controller (a hedge must not delay other work)
+    and the hedge budget allows it. The loser is cancelled.
+    """
+    def call():
+        return call_openai_api(messages, model, reasoning_effort, stage, difficulty, tier)
+
+    if not LLM_HEDGING:
+        return await call()
+    hedge_budget.on_primary()
+    primary = asyncio.create_task(call())
+    threshold = stage_latencies.percentile(f"{stage}@{tier}" if tier else stage,
+                                           LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES)
+    if threshold is None:
+        return await primary
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=threshold)
+        if done or llm_controller.queue_depth > 0 or not hedge_budget.take():
+            return await primary
+    except BaseException:
+        primary.cancel()
+        raise
+
+    hedge = asyncio.create_task(call())
+    pending = {primary, hedge}
+    first_error = None
+    winner = None
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    break
+                if first_error is None or task is primary:
+                    first_error = task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+        hedge_budget.done(won=winner is hedge)
+    if winner is None:
+        raise first_error
+    return winner.result()
+
+def repair_llm_json(text: str) -> str:
+    """Strip code fences and any text around the outermost JSON object"""
+    text = text.strip()
+    fenced = re.match(r"^```[\w-]*\s*(.*?)\s*```", text, re.S)
+    if fenced:
+        text = fenced.group(1)
+    start = text.find("{")
+    if start == -1:
+        return text
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return text[start:]
+
+def parse_llm_json(text: str, response_model: Type[BaseModel]) -> Tuple[BaseModel, str]:
+    """Validate LLM output against response_model, repairing it locally if needed.
+
+    Returns the parsed model and the (possibly repaired) JSON text. Raises
+    ValueError (including pydantic's ValidationError) if it cannot be used.
+    """
+    if not isinstance(text, str):
+        # No content, e.g. a refusal or a response cut off by the length limit
+        raise ValueError(f"Expected JSON text, got {type(text).__name__}")
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        text = repair_llm_json(text)
+        data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected a JSON object, got {type(data).__name__}")
+    return response_model(**data), text
+
+async def call_llm_json(messages: List[Dict[str, str]],
+                        response_model: Type[BaseModel],
+                        stage: str = "unknown",
+                        difficulty: Optional[int] = None,
+                        escalation: int = 0) -> BaseModel:
+    """Call OpenAI and validate the JSON output against response_model.
+
+    The model and reasoning effort come from the stage's tier (see
+    select_tier). Responses go through the LLM cache; only responses that
+    validate are stored. Transient API errors are retried with backoff on the
+    same tier, unusable output one tier up.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        tier = select_tier(stage, difficulty, escalation)
+        model, reasoning_effort = LLM_TIERS[tier]
+        cache_key = None
+        cache = get_llm_cache()
+        if cache is not None:
+            cache_key = cache.make_key(model, reasoning_effort, messages)
+            if LLM_CACHE_MODE == "replay" or (
+                    LLM_CACHE_MODE == "readwrite" and not current_llm_cache_bypass.get()):
+                replay = LLM_CACHE_MODE == "replay"
+                cached = await asyncio.to_thread(cache.get, cache_key, replay)
+                if cached is not None:
+                    return response_model(**json.loads(cached))
+                if replay:
+                    raise HTTPException(status_code=500,
+                                        detail="No recorded OpenAI response for this prompt "
+                                               "(LLM_CACHE_MODE=replay)")
+        try:
+            response = await call_openai_hedged(messages, model, reasoning_effort,
+                                                stage, difficulty, tier)
+            parsed, response = parse_llm_json(response, response_model)
+            break
+        except (LLMCallError, ValueError) as e:
+            if (isinstance(e, LLMCallError) and not e.retryable) or (
+                    attempt >= LLM_MAX_ATTEMPTS or not take_retry()):
+                metrics.inc("mcq_llm_failures_total", metric_labels(stage, difficulty))
+                raise
+            reason = "invalid_output" if isinstance(e, ValueError) else "api_error"
+            metrics.inc("mcq_llm_retries_total", metric_labels(stage, difficulty, reason=reason))
+            timings = current_request_timings.get()
+            if timings is not None:
+                timings.record_retry(stage)
+            if isinstance(e, ValueError):
+                escalation += 1
+            print(f"Retrying {response_model.__name__} call (attempt {attempt} failed): {str(e)}")
+            await asyncio.sleep(retry_delay(attempt))
+    if cache_key is not None:
+        await asyncio.to_thread(cache.put, cache_key, response)
+    return parsed
 
 # Prompts and constants (to be filled)
 
@@ -136,14 +1094,6 @@ question_json_structure = '''{
       "lo_code_specific_to_this_question": "string",
       "task_verb": "string",
       "difficulty": "integer"
-    },
-    {
-      "question_number": 2,
-      "question_text": "string",
-      "ek_code_specific_to_this_question": "string",
-      "lo_code_specific_to_this_question": "string",
-      "task_verb": "string",
-      "difficulty": "integer"
     }
   ]
 }'''
@@ -173,12 +1123,162 @@ explanation_json_structure = '''{
   }
 }'''
 
+single_distractor_json_structure = '''{
+  "distractor": { "response_text": "string" }
+}'''
+
+fused_json_structure = '''{
+  "correct_answer": {
+    "response_text": "string"
+  },
+  "distractors": {
+    "d1": { "response_text": "string" },
+    "d2": { "response_text": "string" },
+    "d3": { "response_text": "string" }
+  },
+  "explanations": {
+    "correct_answer_explanation": "string",
+    "distractor_explanations": {
+      "d1": { "explanation": "string" },
+      "d2": { "explanation": "string" },
+      "d3": { "explanation": "string" }
+    }
+  }
+}'''
+
+# Prompt assembly. Every call sends two messages:
+#   system: STATIC_PROMPT_PREFIX, then the article (or the passages retrieved
+#           for the question) and the EK/LO codes
+#   user:   the stage's PromptTemplate instructions and schema, then the
+#           per-call details (question, answers, feedback, ...)
+# All calls for a bank that send the whole article start with the same
+# system message byte for byte, so the provider's prompt cache can serve it;
+# calls of the same stage also share the stage instructions. The constant
+# parts are assembled once, at import.
+BLOOMS_TAGS = {1: "blooms_easy", 2: "blooms_moderate", 3: "blooms_difficult"}
+
+STATIC_PROMPT_PREFIX = f"""The task concerns AP level learning assessments that test whether students read an article and can connect it to the essential knowledge <ek> and learning objectives <lo> given with it.
+This reference material is used throughout the task:
+<blooms_easy>{blooms_easy}</blooms_easy>
+<blooms_moderate>{blooms_moderate}</blooms_moderate>
+<blooms_difficult>{blooms_difficult}</blooms_difficult>
+<question_criteria>{qcriteria}</question_criteria>
+<correct_criteria>{correct_criteria}</correct_criteria>
+<distractor_criteria>{distractor_criteria}</distractor_criteria>
+<explanation_criteria>{explanation_criteria}</explanation_criteria>
+<absolutes>{absolutes}</absolutes>
+You have to cleverly add escape characters if something could break the JSON from being processed through code. You have to strictly use the provided schema.
+"""
+
+def blooms_reference(difficulty: int) -> str:
+    """Points the model at the Bloom's table for a difficulty in the static prefix"""
+    tag = BLOOMS_TAGS.get(difficulty, BLOOMS_TAGS[3])
+    return f"Bloom's table: use the task verbs in the <{tag}> table"
+
+class PromptTemplate:
+    """A stage's prompt: instructions and JSON schema compiled once, per-call details last"""
+
+    def __init__(self, instructions: str, schema: str):
+        self.instructions = (
+            f"{instructions}\n"
+            f"Please output your response in this exact JSON format without any additional text outside JSON:\n"
+            f"{schema}\n"
+            f"This is the task:\n")
+
+    def messages(self, context: str, request_data: "QuestionRequest",
+                 details: str) -> List[Dict[str, str]]:
+        return [
+            {"role": "system",
+             "content": f"{STATIC_PROMPT_PREFIX}<article>{context}</article>\n"
+                        f"<ek>{request_data.ek_codes}</ek>\n<lo>{request_data.lo_codes}</lo>"},
+            {"role": "user", "content": self.instructions + details},
+        ]
+
+QUESTION_SET_PROMPT = PromptTemplate("""You are a psychometrician turned high school teacher. Your task is building AP level learning assessments.
++Use task verbs from the Bloom's table named in the task to write exactly the number of questions it asks for. The questions will prove a student can connect the article information to their understanding
++Read the <questions> that are already on the assessment to ensure you do not write a duplicate question.
++Follow the specific <question_criteria>
++You must write the questions without using and to create compund questions.
++Ask the questions in the format "which" "what" "how" "why"  etc
++For each question, specify which ek_code and lo_code it addresses from <ek> and <lo>
++Do not refer to the article in the question. students know where the questions come from.
++The questions array must have exactly as many items as questions asked for.""", question_json_structure)
+
+CORRECT_ANSWER_PROMPT = PromptTemplate("""You are a student who has to take an AP assessment.
+The teacher wants to be sure you read the article, and that you understand how to connect <ek> and other information in the article to the important <lo> and has written an assignment.
++You must first identify the task verb used in the question. Review the Bloom's table named in the task to ensure that you correctly follow the necessary steps to answer the question.
+-(e.g. if the question asks for a definition, you will provide a definition in the correct response)
++The teacher also gave you <correct_criteria> to teach you how to answer these questions and do well on the AP Exam.
++You must answer this question correctly in only 1 sentence of less than 20 words.
++You have to use information found in the article along with your existing knowledge of the topic
++Do not restate the question in your response.
+Please make sure you strictly follow the JSON schema and write the correct answer.
++The response must be factually correct""", correct_answer_json_structure)
+
+DISTRACTORS_PROMPT = PromptTemplate("""You are a psychometrician turned high school teacher. Your task is building assessments for AP level learning assessments.
+The <question> and the <correct> answer are already written.
+A distractor is a believable lie that a teacher might tell to determine whether a student read the article before the exam.
+Now you must devise exactly three plausible distractors to the question that will trick students who came to class but did not read the article well.
++Even though a response is incorrect, it must address all parts of the question.
+You must first identify the task verb used in the question. Review the Bloom's table named in the task to ensure that you understand the taskverbs and do what the question is asking.
++You have to use information found in the article along with your existing knowledge about the topic
++Distractors must be very similar to the correct response. Review the <distractor_criteria>
++Do not restate the question in your response.
+Please make sure you strictly follow the JSON schema and write the distractors.
++You must write the distractors for this question in only 1 sentence of less than 20 words each.
++You must write all 3 distractors.""", distractor_json_structure)
+
+SINGLE_DISTRACTOR_PROMPT = PromptTemplate("""You are a psychometrician turned high school teacher. Your task is building assessments for AP level learning assessments.
+The <question>, the <correct> answer and the <other_distractors> are already written.
+A distractor is a believable lie that a teacher might tell to determine whether a student read the article before the exam.
++Write one replacement for the <rejected> distractor that fixes the problems in the <feedback>
+You must first identify the task verb used in the question. Review the Bloom's table named in the task to ensure that you understand the taskverbs and do what the question is asking.
++Distractors must be very similar to the correct response. Review the <distractor_criteria>
++Do not use any of the <absolutes> words
++Be different in interpretation from the correct response and the other distractors.""",
+    single_distractor_json_structure)
+
+EXPLANATIONS_PROMPT = PromptTemplate("""You are a psychometrician turned high school teacher. Your task is writing feedback for the students in your class.
++See the <question> and the guidelines for feedback in <explanation_criteria>
++One student wrote the <correct> response using the information from the article, follow the criteria to explain in 1-2 sentences why this information is correct to solidify their learning
++Three students wrote incorrect responses <distractors>. using the information from the article, your own knowledge of the topic and the images, follow the criteria to explain in 1-2 sentences why this information is wrong to strengthen their understanding
+         +Rather than referring to the article, start each explanation with "This answer is correct/incorrect. You previously learned" followed by the correct information that would help answer the question
+          +If the information is not directly in the article, explain how the student could apply critical thinking to arrive at the correct response.
+         +DO NOT REFER TO THE ARTICLE OR THE READING MATERIAL directly. You have to use that along with your own knowledge to write high quality explanations.
+        +You must write explanations for the correct answer and all distractors using both the article and relevant images. If the information in the article is not sufficient, then you can use your own knowledge to write the explanations.
+        You have already been provided with the correct and the incorrect responses you have to write the explanations based on that information.""",
+    explanation_json_structure)
+
+FUSED_OPTIONS_PROMPT = PromptTemplate("""You are a psychometrician turned high school teacher. Your task is building AP level learning assessments.
+You must first identify the task verb used in the <question>. Review the Bloom's table named in the task to ensure that you correctly follow the necessary steps to answer the question.
+Step 1: write the correct answer.
++Follow the <correct_criteria>
++You must answer this question correctly in only 1 sentence of less than 20 words. Do not restate the question in your response.
+Step 2: write exactly three distractors. A distractor is a believable lie that a teacher might tell to determine whether a student read the article before the exam.
++Distractors must be very similar to the correct response. Follow the <distractor_criteria>
++Do not use any of the <absolutes> words
++Each distractor is 1 sentence within 2 words of the length of the correct answer, with the same number of commas. Even though a response is incorrect, it must address all parts of the question.
+Step 3: write feedback for every response following the <explanation_criteria>
++Start each explanation with "This answer is correct/incorrect. You previously learned" followed by the correct information that would help answer the question.
++DO NOT REFER TO THE ARTICLE OR THE READING MATERIAL directly. If the information in the article is not sufficient, use your own knowledge.
+You have to use information found in the article along with your existing knowledge of the topic.""",
+    fused_json_structure)
+
+# Bank size. Each difficulty's questions are written in parallel batches of
+# up to QUESTION_SET_BATCH_SIZE; a bank may hold at most BANK_MAX_QUESTIONS.
+DEFAULT_QUESTIONS_PER_DIFFICULTY = {1: 2, 2: 2, 3: 2}
+BANK_MAX_QUESTIONS = int(os.getenv("BANK_MAX_QUESTIONS", "60"))
+QUESTION_SET_BATCH_SIZE = int(os.getenv("QUESTION_SET_BATCH_SIZE", "5"))
+
 # Pydantic models for request/response validation
 class QuestionRequest(BaseModel):
     article: str
     current_question_bank: str
     ek_codes: str
     lo_codes: str
+    # Number of questions to write for difficulty 1, 2 and 3
+    questions_per_difficulty: Dict[int, int] = Field(
+        default_factory=lambda: dict(DEFAULT_QUESTIONS_PER_DIFFICULTY))
 
 class Question(BaseModel):
     question_number: int
@@ -208,6 +1308,14 @@ class Distractors(BaseModel):
 class DistractorsResponse(BaseModel):
     distractors: Distractors
 
+class SingleDistractorResponse(BaseModel):
+    distractor: DistractorResponse
+
+class OptionViolation(BaseModel):
+    option: str  # "correct", "d1", "d2" or "d3"
+    rule: str
+    message: str
+
 class DistractorExplanation(BaseModel):
     explanation: str
 
@@ -223,6 +1331,9 @@ class Explanations(BaseModel):
 class ExplanationsResponse(BaseModel):
     explanations: Explanations
 
+class FusedOptionsResponse(CorrectAnswerResponse, DistractorsResponse, ExplanationsResponse):
+    """Output of the fused call: all three staged response models at once"""
+
 class MCQResponse(BaseModel):
     label: str
     isCorrect: bool
@@ -235,108 +1346,687 @@ class MCQuestion(BaseModel):
 
 class QuestionBankResponse(BaseModel):
     questionBank: List[MCQuestion]
+    # Per difficulty {"requested": n, "missing": n}, only when the bank came up short
+    shortfall: Optional[Dict[int, Dict[str, int]]] = None
+    debug: Optional[Dict[str, Any]] = None  # timing breakdown, only with ?debug=true
 
+# Targeted edits to an existing bank, and the stages each one re-runs
+EDIT_OPERATIONS = {
+    "replace_question": ("question_set", "correct_answer", "distractors", "explanations"),
+    "regenerate_distractors": ("distractors", "explanations"),
+    "regenerate_explanations": ("explanations",),
+}
 
+class QuestionEditRequest(BaseModel):
+    request: QuestionRequest  # the request the bank was generated from (codes may be edited)
+    bank: QuestionBankResponse
+    question_number: int  # 1-based position in bank.questionBank
+    operation: str  # one of EDIT_OPERATIONS
+    # Edited correct answer for regenerate_explanations (default: the one in the bank)
+    correct_answer: Optional[str] = None
+    feedback: str = ""  # teacher's note passed to the model
 
-def generate_question_set(difficulty: int, blooms: str, 
-                         request_data: QuestionRequest) -> List[Question]:
-    """Generate questions for a specific difficulty level"""
-    prompt = f"""You are a psychometrician turned high school teacher. Your task is building AP level learning assessments.
-The assessment is to test whether students read this <article>{request_data.article}</article>
-+Use task verbs from <blooms>{blooms}</blooms> to write exactly three questions that will prove a student can connect the article information to their understanding
-+Read these <questions>{request_data.current_question_bank}</questions> that are already on the assessment to ensure you do not write a duplicate question.
-+Follow these specific <criteria>{qcriteria}</criteria>
-+You must write the 2 questions without using and to create compund questions.
-+Ask the 2 questions in the format "which" "what" "how" "why"  etc
-+For each question, specify which ek_code and lo_code it addresses from <ek>{request_data.ek_codes}</ek> and <lo>{request_data.lo_codes}</lo>
-+Do not refer to the article in the question. students know where the questions come from.
-+All questions in this set should have difficulty: {difficulty}
-You have to cleverly add escape characters if something could break the JSON from being processed through code. You have to strictly use the provided schema.
 
-Please output your response in this exact JSON format without any additional text outside JSON:
-{question_json_structure}"""
-    response = call_openai_api([{"role": "user", "content": prompt}])
-    
-    questions_json = json.loads(response)
-    return QuestionsResponse(**questions_json).questions
 
-def generate_correct_answer(question: Question, 
-                          request_data: QuestionRequest) -> str:
-    """Generate correct answer for a single question"""
-    blooms = blooms_easy if question.difficulty == 1 else (
-        blooms_moderate if question.difficulty == 2 else blooms_difficult)
-    
-    prompt = f"""You are a student who has to take an AP assessment.
-The teacher wants to be sure you read <article>{request_data.article}</article>, and that you understand how to connect <ek>{request_data.ek_codes}</ek> and other information in the article to the important <lo>{request_data.lo_codes}</lo> and has written an assignment.
-This is the question <question>{question.question_text}</question>.
-+You must first identify the task verb used in the question. Review Blooms <difficulty>{blooms}</difficulty> to ensure that you correctly follow the necessary steps to answer the question.
--(e.g. if the question asks for a definition, you will provide a definition in the correct response)
-+The teacher also gave you <criteria>{correct_criteria}</criteria> to teach you how to answer these questions and do well on the AP Exam.
-+You must answer this question correctly in only 1 sentence of less than 20 words.
-+You have to use information found in the article along with your existing knowledge of the topic
-+Do not restate the question in your response.
-+You must answer this question correctly in only 1 sentence of less than 20 words.
-Please make sure you strictly follow the JSON schema and write the correct answer.
-+The response must be factually correct
-You have to cleverly add escape characters if something could break the JSON from being processed through code. You have to strictly use the provided schema.
+# Near-duplicate detection against current_question_bank. Only the
+# QUESTION_BANK_PROMPT_ITEMS existing questions most relevant to the article
+# go into the prompt; generated questions are checked against the whole bank.
+QUESTION_BANK_PROMPT_ITEMS = int(os.getenv("QUESTION_BANK_PROMPT_ITEMS", "15"))
+DUPLICATE_SIMILARITY_THRESHOLD = float(os.getenv("DUPLICATE_SIMILARITY_THRESHOLD", "0.8"))
+DUPLICATE_MAX_ROUNDS = int(os.getenv("DUPLICATE_MAX_ROUNDS", "2"))
+QUESTION_INDEX_CACHE_SIZE = 32
 
-Please output your response in this exact JSON format without any additional text outside JSON:
-{correct_answer_json_structure}"""
-    response = call_openai_api([{"role": "user", "content": prompt}])
-    
-    correct_json = json.loads(response)
-    return CorrectAnswerResponse(**correct_json).correct_answer.response_text
+TERM_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset("""a an the of to in on at by for with from as and or but is are was were be been
+it its this that these those which what how why when where who whom does do did can could would
+should will may might most best following statement""".split())
+QUESTION_PREFIX_PATTERN = re.compile(r"^\s*(?:[-*\u2022]+|\(?[Qq]?\d+[.):]|[Qq]\d*[.:])\s*")
 
-def generate_distractors(question: Question, correct_answer: str, 
-                        request_data: QuestionRequest) -> Distractors:
-    """Generate distractors for a single question"""
-    blooms = blooms_easy if question.difficulty == 1 else (
-        blooms_moderate if question.difficulty == 2 else blooms_difficult)
-    
-    prompt = f"""You are a psychometrician turned high school teacher. Your task is building assessments for AP level learning assessments.
-The assessment is to test whether students read this <article>{request_data.article}</article>
-The <question>{question.question_text}</question> and the <correct>{correct_answer}</correct> are already written.
-A distractor is a believable lie that a teacher might tell to determine whether a student read the article before the exam.
-Now you must devise exactly three plausible distractors to the question that will trick students who came to class but did not read the article well.
-+Even though a response is incorrect, it must address all parts of the question.
-You must first identify the task verb used in the question. Review Blooms <blooms>{blooms}</blooms> to ensure that you understand the taskverbs and do what the question is asking.
-+You have to use information found in the article along with your existing knowledge about the topic
-+Distractors must be very similar to the correct response. Review the <criteria>{distractor_criteria}</criteria>
-+Do not restate the question in your response.
-Please make sure you strictly follow the JSON schema and write the distractors.
-+You must write the distractors for this question in only 1 sentence of less than 20 words each.
-+You must write all 3 distractors.
-You have to cleverly add escape characters if something could break the JSON from being processed through code. You have to strictly use the provided schema.
+def tokenize_terms(text: str) -> List[str]:
+    """Content words plus adjacent word pairs"""
+    words = [w for w in TERM_PATTERN.findall(text.lower()) if w not in STOP_WORDS]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
 
-Please output your response in this exact JSON format without any additional text outside JSON:
-{distractor_json_structure}"""
-    response = call_openai_api([{"role": "user", "content": prompt}])
-    
-    distractors_json = json.loads(response)
-    return DistractorsResponse(**distractors_json).distractors
+def split_question_bank(text: str) -> List[str]:
+    """Split the free-text question bank into individual questions"""
+    questions = []
+    for line in text.splitlines():
+        for part in re.split(r"(?<=\?)\s+", line):
+            part = QUESTION_PREFIX_PATTERN.sub("", part).strip()
+            if len(part.split()) >= 3:
+                questions.append(part)
+    return questions
+
+class QuestionSimilarityIndex:
+    """TF-IDF cosine similarity index over the questions already in a bank"""
+
+    def __init__(self, questions: List[str]):
+        self.questions = questions
+        tokenized = [tokenize_terms(q) for q in questions]
+        doc_freq = Counter()
+        for terms in tokenized:
+            doc_freq.update(set(terms))
+        n = len(questions)
+        self.idf = {term: math.log((1 + n) / (1 + df)) + 1 for term, df in doc_freq.items()}
+        self.default_idf = math.log(1 + n) + 1
+        # Inverted index: term -> [(question index, weight)]
+        self.postings: Dict[str, List[Tuple[int, float]]] = {}
+        for i, terms in enumerate(tokenized):
+            for term, weight in self._weigh(terms).items():
+                self.postings.setdefault(term, []).append((i, weight))
+
+    def _weigh(self, terms: List[str]) -> Dict[str, float]:
+        counts = Counter(terms)
+        vector = {t: c * self.idf.get(t, self.default_idf) for t, c in counts.items()}
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        return {t: w / norm for t, w in vector.items()}
+
+    def vectorize(self, text: str) -> Dict[str, float]:
+        return self._weigh(tokenize_terms(text))
+
+    @staticmethod
+    def cosine(a: Dict[str, float], b: Dict[str, float]) -> float:
+        if len(a) > len(b):
+            a, b = b, a
+        return sum(w * b.get(t, 0.0) for t, w in a.items())
+
+    def scores(self, text: str) -> Dict[int, float]:
+        """Cosine similarity of text to every bank question that shares a term with it"""
+        scores: Dict[int, float] = {}
+        for term, weight in self.vectorize(text).items():
+            for i, doc_weight in self.postings.get(term, ()):
+                scores[i] = scores.get(i, 0.0) + weight * doc_weight
+        return scores
+
+    def most_similar(self, text: str) -> Tuple[float, Optional[str]]:
+        scores = self.scores(text)
+        if not scores:
+            return 0.0, None
+        best = max(scores, key=scores.get)
+        return scores[best], self.questions[best]
+
+    def relevant(self, query: str, k: int) -> List[str]:
+        """The k bank questions closest to query, in their original bank order"""
+        if len(self.questions) <= k:
+            return list(self.questions)
+        scores = self.scores(query)
+        top = sorted(scores, key=scores.get, reverse=True)[:k]
+        return [self.questions[i] for i in sorted(top)]
+
+_question_index_cache: "OrderedDict[str, QuestionSimilarityIndex]" = OrderedDict()
+
+def get_question_index(question_bank: str) -> QuestionSimilarityIndex:
+    """Index for a question bank, built once and reused for identical banks"""
+    key = hashlib.sha256(question_bank.encode("utf-8")).hexdigest()
+    index = _question_index_cache.get(key)
+    if index is None:
+        index = QuestionSimilarityIndex(split_question_bank(question_bank))
+        _question_index_cache[key] = index
+        while len(_question_index_cache) > QUESTION_INDEX_CACHE_SIZE:
+            _question_index_cache.popitem(last=False)
+    else:
+        _question_index_cache.move_to_end(key)
+    return index
+
+def find_duplicate(question_text: str, index: QuestionSimilarityIndex,
+                   accepted: List[str]) -> Optional[str]:
+    """The existing or already-accepted question that question_text nearly duplicates"""
+    score, match = index.most_similar(question_text)
+    if score >= DUPLICATE_SIMILARITY_THRESHOLD:
+        return match
+    vector = index.vectorize(question_text)
+    for other in accepted:
+        if index.cosine(vector, index.vectorize(other)) >= DUPLICATE_SIMILARITY_THRESHOLD:
+            return other
+    return None
+
+# Passage retrieval: per-question stages get the ARTICLE_PASSAGES_TOP_K
+# passages most relevant to the question instead of the whole article.
+# Articles shorter than ARTICLE_RETRIEVAL_MIN_WORDS are always sent whole.
+ARTICLE_PASSAGES_TOP_K = int(os.getenv("ARTICLE_PASSAGES_TOP_K", "4"))
+ARTICLE_PASSAGE_WORDS = int(os.getenv("ARTICLE_PASSAGE_WORDS", "120"))
+ARTICLE_RETRIEVAL_MIN_WORDS = int(os.getenv("ARTICLE_RETRIEVAL_MIN_WORDS", "600"))
+ARTICLE_INDEX_CACHE_SIZE = 32
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token for English)"""
+    return (len(text) + 3) // 4
+
+def split_passages(article: str, max_words: int) -> List[str]:
+    """Split an article into paragraphs, breaking long ones at sentence boundaries"""
+    passages = []
+    for paragraph in re.split(r"\n\s*\n", article):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph.split()) <= max_words:
+            passages.append(paragraph)
+            continue
+        current: List[str] = []
+        current_words = 0
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+            words = len(sentence.split())
+            if current and current_words + words > max_words:
+                passages.append(" ".join(current))
+                current, current_words = [], 0
+            current.append(sentence)
+            current_words += words
+        if current:
+            passages.append(" ".join(current))
+    return passages
+
+class ArticleIndex:
+    """BM25 index over the passages of one article"""
+
+    def __init__(self, article: str, passage_words: int):
+        self.article = article
+        self.passages = split_passages(article, passage_words)
+        self.word_count = len(article.split())
+        self.term_counts = [Counter(TERM_PATTERN.findall(p.lower())) for p in self.passages]
+        self.lengths = [sum(c.values()) for c in self.term_counts]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        doc_freq = Counter()
+        for counts in self.term_counts:
+            doc_freq.update(counts.keys())
+        n = len(self.passages)
+        self.idf = {t: math.log(1 + (n - df + 0.5) / (df + 0.5)) for t, df in doc_freq.items()}
+
+    def score(self, query: str) -> List[float]:
+        terms = [t for t in TERM_PATTERN.findall(query.lower()) if t not in STOP_WORDS]
+        scores = []
+        for counts, length in zip(self.term_counts, self.lengths):
+            score = 0.0
+            for term in terms:
+                tf = counts.get(term)
+                if tf:
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / (self.avg_length or 1.0))
+                    score += self.idf[term] * tf * (BM25_K1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+    def top_passages(self, query: str, k: int) -> Optional[str]:
+        """The k best-matching passages joined in article order, or None if nothing matches"""
+        scores = self.score(query)
+        top = [i for i in sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k]
+               if scores[i] > 0]
+        if not top:
+            return None
+        return "\n\n".join(self.passages[i] for i in sorted(top))
+
+class RetrievalStats:
+    """Article tokens that per-question prompts would have sent vs. actually sent"""
+
+    def __init__(self):
+        self.full_tokens = 0
+        self.sent_tokens = 0
+
+    def record(self, full: str, sent: str):
+        self.full_tokens += estimate_tokens(full)
+        self.sent_tokens += estimate_tokens(sent)
+
+    def summary(self) -> Dict[str, int]:
+        return {
+            "full_article_tokens": self.full_tokens,
+            "sent_article_tokens": self.sent_tokens,
+            "saved_tokens": self.full_tokens - self.sent_tokens,
+        }
+
+current_retrieval_stats: ContextVar[Optional[RetrievalStats]] = ContextVar(
+    "current_retrieval_stats", default=None)
+
+_article_index_cache: "OrderedDict[str, ArticleIndex]" = OrderedDict()
+
+def get_article_index(article: str) -> ArticleIndex:
+    """Index for an article, built once and reused for identical articles"""
+    key = hashlib.sha256(article.encode("utf-8")).hexdigest()
+    index = _article_index_cache.get(key)
+    if index is None:
+        index = ArticleIndex(article, ARTICLE_PASSAGE_WORDS)
+        _article_index_cache[key] = index
+        while len(_article_index_cache) > ARTICLE_INDEX_CACHE_SIZE:
+            _article_index_cache.popitem(last=False)
+    else:
+        _article_index_cache.move_to_end(key)
+    return index
+
+def article_context(question: Question, request_data: QuestionRequest) -> str:
+    """The part of the article a per-question prompt needs"""
+    article = request_data.article
+    context = article
+    if ARTICLE_PASSAGES_TOP_K > 0:
+        index = get_article_index(article)
+        if (index.word_count >= ARTICLE_RETRIEVAL_MIN_WORDS
+                and len(index.passages) > ARTICLE_PASSAGES_TOP_K):
+            context = index.top_passages(
+                f"{question.question_text} {question.ek_code_specific_to_this_question}",
+                ARTICLE_PASSAGES_TOP_K) or article
+    stats = current_retrieval_stats.get()
+    if stats is not None:
+        stats.record(article, context)
+    return context
+
+async def generate_question_set(difficulty: int,
+                         request_data: QuestionRequest,
+                         count: int,
+                         avoid: List[str] = (),
+                         focus: str = "",
+                         feedback: str = "") -> List[Question]:
+    """Generate up to count questions for a specific difficulty level"""
+    index = get_question_index(request_data.current_question_bank)
+    existing_questions = "\n".join(index.relevant(
+        " ".join([request_data.ek_codes, request_data.lo_codes, request_data.article]),
+        QUESTION_BANK_PROMPT_ITEMS))
+    details = f"<questions>{existing_questions}</questions>\n{blooms_reference(difficulty)}\n"
+    if avoid:
+        avoid_questions = "\n".join(avoid)
+        details += f"+Do not write questions similar to these <avoid>{avoid_questions}</avoid>\n"
+    if focus:
+        details += f"+Base these questions mainly on this part of the article <focus>{focus}</focus>\n"
+    details += (f"{feedback_section(feedback)}+Write exactly {count} questions.\n"
+                f"+All questions in this set should have difficulty: {difficulty}")
+    response = await call_llm_json(
+        QUESTION_SET_PROMPT.messages(request_data.article, request_data, details),
+        QuestionsResponse, stage="question_set", difficulty=difficulty)
+    return response.questions[:count]
+
+def is_shortfall_error(error: BaseException) -> bool:
+    """Whether a failed question set just leaves questions missing: unusable
+    output or an API error that may succeed on another try"""
+    if isinstance(error, LLMCallError):
+        return error.retryable
+    return isinstance(error, ValueError)
+
+async def generate_question_set_with_recovery(difficulty: int,
+                                             request_data: QuestionRequest,
+                                             count: int,
+                                             avoid: List[str] = (),
+                                             focus: str = "",
+                                             feedback: str = "") -> List[Question]:
+    """Generate a question set, asking again while the bank has retries left.
+
+    call_llm_json gives up after LLM_MAX_ATTEMPTS; like a question's chain,
+    a question set then gets another go as long as BANK_RETRY_BUDGET allows.
+    """
+    while True:
+        try:
+            return await generate_question_set(difficulty, request_data, count, avoid, focus,
+                                               feedback)
+        except (LLMCallError, ValueError) as e:
+            if isinstance(e, LLMCallError) and not e.retryable:
+                raise
+            if not take_retry():
+                raise
+            print(f"Regenerating question set at difficulty {difficulty}: {str(e)}")
+
+def question_plan(request: QuestionRequest) -> Dict[int, int]:
+    """Questions to write per difficulty; raises a 400 for an invalid mix"""
+    plan = {difficulty: request.questions_per_difficulty.get(difficulty, 0)
+            for difficulty in (1, 2, 3)}
+    unknown = set(request.questions_per_difficulty) - set(plan)
+    if unknown or any(count < 0 for count in plan.values()):
+        raise HTTPException(status_code=400,
+                            detail="questions_per_difficulty takes non-negative counts "
+                                   "for difficulties 1, 2 and 3")
+    total = sum(plan.values())
+    if not 0 < total <= BANK_MAX_QUESTIONS:
+        raise HTTPException(status_code=400,
+                            detail=f"A bank must have between 1 and {BANK_MAX_QUESTIONS} "
+                                   f"questions, got {total}")
+    return plan
+
+def split_batches(count: int, batch_size: int) -> List[int]:
+    """Split count into the fewest batches of at most batch_size, evenly sized"""
+    batches = math.ceil(count / max(1, batch_size))
+    return [count // batches + (1 if i < count % batches else 0) for i in range(batches)]
+
+def article_focuses(article: str, batches: int) -> List[str]:
+    """One contiguous slice of the article per parallel batch, so that the
+    batches write about different parts of it (empty if it is too short)"""
+    passages = split_passages(article, ARTICLE_PASSAGE_WORDS)
+    if batches < 2 or len(passages) < batches:
+        return [""] * batches
+    per_batch = math.ceil(len(passages) / batches)
+    return [" ".join(passages[i * per_batch:(i + 1) * per_batch]) or article
+            for i in range(batches)]
+
+async def generate_unique_question_set(difficulty: int,
+                                      request_data: QuestionRequest,
+                                      accepted: List[str],
+                                      count: int,
+                                      avoid: List[str] = (),
+                                      on_questions: Optional[
+                                          Callable[[List[Question]], Awaitable[None]]] = None,
+                                      feedback: str = "") -> List[Question]:
+    """Write count questions for a difficulty in parallel batches, without duplicates.
+
+    accepted holds questions already kept for this request (shared across
+    difficulties); kept questions are added to it. avoid lists questions the
+    model is told not to repeat (e.g. one a teacher rejected), and feedback
+    is passed to every batch. Questions that duplicate
+    the bank, another batch or another difficulty are dropped, and the
+    shortfall is re-requested for up to DUPLICATE_MAX_ROUNDS rounds. After
+    that, near duplicates are kept (and logged) to fill the set. A batch
+    that fails counts as a shortfall too; the set only fails if no batch
+    returned anything.
+
+    Each batch is checked as soon as it returns, and on_questions receives
+    the questions kept from it, so callers can start on them while other
+    batches and top-up rounds are still running.
+    """
+    index = get_question_index(request_data.current_question_bank)
+    kept: List[Question] = []
+    duplicates: List[Tuple[Question, str]] = []  # (question, question it duplicates)
+    error: Optional[Exception] = None
 
-def generate_explanations(question: Question, correct_answer: str, 
+    async def keep(questions: List[Question]):
+        kept.extend(questions)
+        accepted.extend(q.question_text for q in questions)
+        if questions and on_questions is not None:
+            await on_questions(questions)
+
+    for round_number in range(DUPLICATE_MAX_ROUNDS + 1):
+        missing = count - len(kept)
+        if missing <= 0:
+            break
+        batches = split_batches(missing, QUESTION_SET_BATCH_SIZE)
+        if round_number == 0:
+            round_avoid = list(avoid)
+            focuses = article_focuses(request_data.article, len(batches))
+        else:
+            round_avoid = list(dict.fromkeys(
+                list(avoid) + [text for _, text in duplicates] + accepted))
+            focuses = [""] * len(batches)
+        # Not gather_or_cancel: one failed batch must not cancel the others
+        tasks = [asyncio.ensure_future(generate_question_set_with_recovery(
+                     difficulty, request_data, size, round_avoid, focus, feedback))
+                 for size, focus in zip(batches, focuses)]
+        try:
+            for next_batch in asyncio.as_completed(tasks):
+                try:
+                    batch = await next_batch
+                except (LLMCallError, ValueError) as e:
+                    # Only unusable output and transient API errors are a
+                    # shortfall; anything else (bugs, cache errors, replay
+                    # misses) is raised
+                    if not is_shortfall_error(e):
+                        raise
+                    print(f"Question set batch at difficulty {difficulty} failed: {str(e)}")
+                    error = e
+                    continue
+                new_questions = []
+                for candidate in batch:
+                    if len(kept) + len(new_questions) >= count:
+                        break
+                    duplicate = find_duplicate(candidate.question_text, index,
+                                               accepted + [q.question_text for q in new_questions])
+                    if duplicate is None:
+                        new_questions.append(candidate)
+                    else:
+                        duplicates.append((candidate, duplicate))
+                await keep(new_questions)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    fill = []
+    for question, duplicate in duplicates:
+        if len(kept) + len(fill) >= count:
+            break
+        # Out of rounds: keep the question but flag it
+        print(f"Question {question.question_text!r} at difficulty {difficulty} "
+              f"is a near duplicate of {duplicate!r}")
+        fill.append(question)
+    await keep(fill)
+    if not kept and error is not None:
+        raise error
+    if len(kept) < count:
+        print(f"Only {len(kept)} of {count} questions could be written at difficulty {difficulty}")
+    return kept
+
+async def generate_correct_answer(question: Question, 
+                          request_data: QuestionRequest,
+                          feedback: str = "",
+                          escalation: int = 0) -> str:
+    """Generate correct answer for a single question"""
+    details = (f"<question>{question.question_text}</question>\n"
+               f"{blooms_reference(question.difficulty)}\n{feedback_section(feedback)}")
+    response = await call_llm_json(
+        CORRECT_ANSWER_PROMPT.messages(article_context(question, request_data),
+                                       request_data, details),
+        CorrectAnswerResponse, stage="correct_answer", difficulty=question.difficulty,
+        escalation=escalation)
+    return response.correct_answer.response_text
+
+async def generate_distractors(question: Question, correct_answer: str, 
+                        request_data: QuestionRequest,
+                        feedback: str = "") -> Distractors:
+    """Generate distractors for a single question"""
+    details = (f"<question>{question.question_text}</question>\n"
+               f"<correct>{correct_answer}</correct>\n{blooms_reference(question.difficulty)}\n"
+               f"{feedback_section(feedback)}")
+    response = await call_llm_json(
+        DISTRACTORS_PROMPT.messages(article_context(question, request_data),
+                                    request_data, details),
+        DistractorsResponse, stage="distractors", difficulty=question.difficulty)
+    return response.distractors
+
+async def generate_explanations(question: Question, correct_answer: str, 
                          distractors: Distractors, 
-                         request_data: QuestionRequest) -> Explanations:
+                         request_data: QuestionRequest,
+                         feedback: str = "") -> Explanations:
     """Generate explanations for a single question"""
-    prompt = f"""You are a psychometrician turned high school teacher. Your task is writing feedback for the students in your class.
-The assessment is to test whether students read this <article>{request_data.article}</article>
-+See the <question>{question.question_text}</question> and guidelines for feedback <criteria>{explanation_criteria}</criteria>
-+One student wrote a <correct>{correct_answer}</correct> using the information from the article, follow the criteria to explain in 1-2 sentences why this information is correct to solidify their learning
-+Three students wrote incorrect responses <distractors>{distractors}</distractors>. using the information from the article, follow the criteria to explain in 1-2 sentences why this information is wrong to strengthen their understanding
- using the information from the article, your own knowledge of the topic and the images, follow the criteria to explain in 1-2 sentences why this information is wrong to strengthen their understanding
-         +Rather than referring to the article, start each explanation with "This answer is correct/incorrect. You previously learned" followed by the correct information that would help answer the question
-          +If the information is not directly in the article, explain how the student could apply critical thinking to arrive at the correct response.
-         +DO NOT REFER TO THE ARTICLE OR THE READING MATERIAL directly. You have to use that along with your own knowledge to write high quality explanations.
-        +You must write explanations for the correct answer and all distractors using both the article and relevant images. If the information in the article is not sufficient, then you can use your own knowledge to write the explanations.
-        You have already been provided with the correct and the incorrect responses you have to write the explanations based on that information.
-        You have to cleverly add escape characters if something could break the JSON from being processed through code.
-Please output your response in this exact JSON format without any additional text outside JSON:
-{explanation_json_structure}"""
-    response = call_openai_api([{"role": "user", "content": prompt}])
-    
-    explanations_json = json.loads(response)
-    return ExplanationsResponse(**explanations_json).explanations
+    details = (f"<question>{question.question_text}</question>\n"
+               f"<correct>{correct_answer}</correct>\n<distractors>{distractors}</distractors>\n"
+               f"{feedback_section(feedback)}")
+    response = await call_llm_json(
+        EXPLANATIONS_PROMPT.messages(article_context(question, request_data),
+                                     request_data, details),
+        ExplanationsResponse, stage="explanations", difficulty=question.difficulty)
+    return response.explanations
+
+# Mechanical answer-option rules from correct_criteria and distractor_criteria
+MAX_OPTION_WORDS = 20
+MAX_DISTRACTOR_WORD_DIFF = 2
+OPTION_REPAIR_ROUNDS = int(os.getenv("OPTION_REPAIR_ROUNDS", "2"))
+
+ABSOLUTE_WORDS = [w for w in re.split(r"[,\s]+", absolutes) if w]
+ABSOLUTES_PATTERN = re.compile(
+    r"\b(" + "|".join(re.escape(w) for w in sorted(ABSOLUTE_WORDS, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE)
+SENTENCE_BREAK_PATTERN = re.compile(r"[.!?]+\s+(?=[A-Z0-9\"'])")
+# A period after one of these words, an initial or a dotted acronym
+# (U.S., e.g., D.C.) does not end the sentence
+ABBREVIATIONS = {"approx", "ca", "cf", "dr", "etc", "fig", "jr", "mr", "mrs", "ms",
+                 "no", "prof", "sr", "st", "vs"}
+DOTTED_ABBREVIATION_PATTERN = re.compile(r"(?:[A-Za-z]\.)+")
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+def ends_with_abbreviation(text: str) -> bool:
+    """Whether the period ending text belongs to an abbreviation or initial"""
+    match = re.search(r"[A-Za-z.]+$", text)
+    if match is None:
+        return False
+    word = match.group()
+    return (DOTTED_ABBREVIATION_PATTERN.fullmatch(word) is not None
+            or word[:-1].lower() in ABBREVIATIONS)
+
+def count_sentences(text: str) -> int:
+    text = text.strip()
+    breaks = [m for m in SENTENCE_BREAK_PATTERN.finditer(text)
+              if not (m.group().startswith(".")
+                      and ends_with_abbreviation(text[:m.start() + 1]))]
+    return len(breaks) + 1
+
+def normalize_option(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", "", text.lower()).split())
+
+def check_sentence_rules(option: str, text: str) -> List[OptionViolation]:
+    """An option must be one sentence of up to MAX_OPTION_WORDS words"""
+    violations = []
+    if count_sentences(text) > 1:
+        violations.append(OptionViolation(
+            option=option, rule="single_sentence",
+            message="Must be a single sentence."))
+    words = count_words(text)
+    if words > MAX_OPTION_WORDS:
+        violations.append(OptionViolation(
+            option=option, rule="max_words",
+            message=f"Has {words} words; must be {MAX_OPTION_WORDS} words or fewer."))
+    return violations
+
+def validate_correct_answer(correct_answer: str) -> List[OptionViolation]:
+    """Check the mechanical rules in correct_criteria"""
+    return check_sentence_rules("correct", correct_answer)
+
+def validate_distractors(correct_answer: str,
+                         distractors: Distractors) -> List[OptionViolation]:
+    """Check the mechanical rules in distractor_criteria against the correct answer"""
+    violations = []
+    correct_words = count_words(correct_answer)
+    correct_commas = correct_answer.count(",")
+    seen = {normalize_option(correct_answer): "the correct answer"}
+    for key in ("d1", "d2", "d3"):
+        text = getattr(distractors, key).response_text
+        violations.extend(check_sentence_rules(key, text))
+        found = sorted({m.lower() for m in ABSOLUTES_PATTERN.findall(text)})
+        if found:
+            violations.append(OptionViolation(
+                option=key, rule="absolutes",
+                message=f"Uses absolute words ({', '.join(found)}); rephrase without them."))
+        words = count_words(text)
+        if abs(words - correct_words) > MAX_DISTRACTOR_WORD_DIFF:
+            violations.append(OptionViolation(
+                option=key, rule="length",
+                message=f"Has {words} words; must be between "
+                        f"{max(1, correct_words - MAX_DISTRACTOR_WORD_DIFF)} and "
+                        f"{correct_words + MAX_DISTRACTOR_WORD_DIFF} words to match the correct answer."))
+        commas = text.count(",")
+        if commas != correct_commas:
+            violations.append(OptionViolation(
+                option=key, rule="commas",
+                message=f"Has {commas} commas; must have exactly {correct_commas} like the correct answer."))
+        normalized = normalize_option(text)
+        if normalized in seen:
+            violations.append(OptionViolation(
+                option=key, rule="distinct",
+                message=f"Is the same as {seen[normalized]}; write a different option."))
+        else:
+            seen[normalized] = key
+    return violations
+
+def feedback_section(feedback: str) -> str:
+    """Prompt lines asking the model to fix a previous attempt, if there is feedback"""
+    if not feedback:
+        return ""
+    return f"+Your previous response was rejected for these reasons, fix them: <feedback>{feedback}</feedback>\n"
+
+async def regenerate_distractor(question: Question, correct_answer: str,
+                                distractors: Distractors, key: str,
+                                violations: List[OptionViolation],
+                                request_data: QuestionRequest,
+                                escalation: int = 0) -> DistractorResponse:
+    """Rewrite one distractor so that it no longer breaks the given rules"""
+    others = "\n".join(getattr(distractors, k).response_text
+                       for k in ("d1", "d2", "d3") if k != key)
+    feedback = " ".join(v.message for v in violations)
+    details = f"""<question>{question.question_text}</question>
+<correct>{correct_answer}</correct>
+<other_distractors>{others}</other_distractors>
+<rejected>{getattr(distractors, key).response_text}</rejected>
+<feedback>{feedback}</feedback>
+{blooms_reference(question.difficulty)}
++Write 1 sentence with {count_words(correct_answer)} words (give or take {MAX_DISTRACTOR_WORD_DIFF}) and exactly {correct_answer.count(",")} commas."""
+    response = await call_llm_json(
+        SINGLE_DISTRACTOR_PROMPT.messages(article_context(question, request_data),
+                                          request_data, details),
+        SingleDistractorResponse, stage="distractor_repair",
+        difficulty=question.difficulty, escalation=escalation)
+    return response.distractor
+
+async def generate_checked_correct_answer(question: Question,
+                                          request_data: QuestionRequest) -> str:
+    """Generate a correct answer, asking again with feedback while it breaks the rules.
+
+    Each new attempt runs one model tier higher than the last.
+    """
+    correct_answer = await generate_correct_answer(question, request_data)
+    for repair_round in range(1, OPTION_REPAIR_ROUNDS + 1):
+        violations = validate_correct_answer(correct_answer)
+        if not violations:
+            break
+        correct_answer = await generate_correct_answer(
+            question, request_data, " ".join(v.message for v in violations),
+            escalation=repair_round)
+    return correct_answer
+
+async def generate_checked_distractors(question: Question, correct_answer: str,
+                                       request_data: QuestionRequest,
+                                       feedback: str = "") -> Distractors:
+    """Generate distractors, then regenerate only the ones that break the rules"""
+    distractors = await generate_distractors(question, correct_answer, request_data, feedback)
+    return await repair_distractors(question, correct_answer, distractors, request_data)
+
+async def repair_distractors(question: Question, correct_answer: str,
+                             distractors: Distractors,
+                             request_data: QuestionRequest) -> Distractors:
+    """Regenerate only the distractors that break the rules, one model tier higher each round"""
+    for repair_round in range(1, OPTION_REPAIR_ROUNDS + 1):
+        violations = validate_distractors(correct_answer, distractors)
+        if not violations:
+            break
+        by_option: Dict[str, List[OptionViolation]] = {}
+        for violation in violations:
+            by_option.setdefault(violation.option, []).append(violation)
+        keys = sorted(by_option)
+        replacements = await gather_or_cancel(
+            *(regenerate_distractor(question, correct_answer, distractors, key,
+                                    by_option[key], request_data, repair_round)
+              for key in keys))
+        distractors = Distractors(**{**distractors.dict(), **dict(zip(keys, replacements))})
+    else:
+        violations = validate_distractors(correct_answer, distractors)
+        if violations:
+            print(f"Question {question.question_number} distractors still break rules: "
+                  f"{[v.rule for v in violations]}")
+    return distractors
+
+async def generate_fused_options(question: Question,
+                                 request_data: QuestionRequest
+                                 ) -> Optional[Tuple[str, Distractors, Explanations]]:
+    """Write the correct answer, distractors and explanations in one call.
+
+    Returns None when the output cannot be used, so the caller falls back to
+    the staged path. Distractors that break the mechanical rules are repaired
+    individually, and their explanations rewritten, instead of falling back.
+    """
+    details = (f"<question>{question.question_text}</question>\n"
+               f"{blooms_reference(question.difficulty)}")
+    messages = FUSED_OPTIONS_PROMPT.messages(article_context(question, request_data),
+                                             request_data, details)
+    try:
+        response = await call_llm_json(messages, FusedOptionsResponse, stage="fused",
+                                       difficulty=question.difficulty)
+    except (LLMCallError, ValueError) as e:
+        if isinstance(e, LLMCallError) and not e.retryable:
+            raise
+        print(f"Fused generation failed for question {question.question_number}, "
+              f"falling back to staged generation: {str(e)}")
+        return None
+
+    correct_answer = response.correct_answer.response_text
+    if validate_correct_answer(correct_answer):
+        return None
+    distractors = await repair_distractors(
+        question, correct_answer, response.distractors, request_data)
+    explanations = response.explanations
+    if distractors != response.distractors:
+        explanations = await generate_explanations(
+            question, correct_answer, distractors, request_data)
+    return correct_answer, distractors, explanations
 
 def format_mcq(question: Question, correct_answer: str, 
                distractors: Distractors, 
@@ -373,142 +2063,866 @@ def format_mcq(question: Question, correct_answer: str,
         difficulty=question.difficulty
     )
 
-def update_question_numbers(questions: List[Question], difficulty: int) -> List[Question]:
-    """Update question numbers based on difficulty level"""
-    offset = (difficulty - 1) * 2  # 0 for diff 1, 2 for diff 2, 4 for diff 3
+def update_question_numbers(questions: List[Question], difficulty: int,
+                            offset: int) -> List[Question]:
+    """Number a difficulty's questions globally, after the offset questions of
+    easier difficulties"""
     updated_questions = []
     for i, q in enumerate(questions, 1):
         q_dict = q.dict()
         q_dict['question_number'] = offset + i
+        q_dict['difficulty'] = difficulty
         updated_questions.append(Question(**q_dict))
     return updated_questions
 
-@app.post("/generate-questions", response_model=QuestionBankResponse)
-def generate_question_bank(request: QuestionRequest):
-    """Main API endpoint to generate question bank"""
+async def gather_or_cancel(*aws):
+    """Like asyncio.gather, but cancels the remaining awaitables on the first failure"""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
     try:
-        all_questions = []
-        
-        # Generate questions for all difficulty levels in parallel
-        difficulties = [
-            (1, blooms_easy),
-            (2, blooms_moderate),
-            (3, blooms_difficult)
-        ]
-        
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            future_to_diff = {
-                executor.submit(generate_question_set, diff, blooms, request): (diff, blooms) 
-                for diff, blooms in difficulties
-            }
-            
-            # Process each difficulty level's questions
-            difficulty_questions = {}
-            for future in as_completed(future_to_diff):
-                diff, _ = future_to_diff[future]
-                questions = future.result()
-                # Update question numbers based on difficulty level
-                updated_questions = update_question_numbers(questions, diff)
-                difficulty_questions[diff] = updated_questions
-
-            # Combine questions in order of difficulty
-            for diff in sorted(difficulty_questions.keys()):
-                all_questions.extend(difficulty_questions[diff])
-
-        # Verify we have 6 questions
-        if len(all_questions) != 6:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Expected 6 questions but got {len(all_questions)}"
-            )
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
 
-        # Create a mapping of question numbers to questions for easy lookup
-        question_map = {q.question_number: q for q in all_questions}
-        
-        # Generate correct answers in parallel
-        correct_answers = {}
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            future_to_question_num = {
-                executor.submit(generate_correct_answer, q, request): q.question_number 
-                for q in all_questions
-            }
-            
-            for future in as_completed(future_to_question_num):
-                question_num = future_to_question_num[future]
-                try:
-                    correct_answers[question_num] = future.result()
-                except Exception as e:
-                    print(f"Error generating correct answer for question {question_num}: {str(e)}")
-                    raise
-        
-        # Generate distractors in parallel
-        distractors = {}
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            future_to_question_num = {
-                executor.submit(
-                    generate_distractors,
-                    question_map[q_num],
-                    correct_answers[q_num],
-                    request
-                ): q_num 
-                for q_num in correct_answers.keys()
-            }
-            
-            for future in as_completed(future_to_question_num):
-                question_num = future_to_question_num[future]
-                try:
-                    distractors[question_num] = future.result()
-                except Exception as e:
-                    print(f"Error generating distractors for question {question_num}: {str(e)}")
-                    raise
-        
-        # Generate explanations in parallel
-        explanations = {}
-        with ThreadPoolExecutor(max_workers=3) as executor:
-            future_to_question_num = {
-                executor.submit(
-                    generate_explanations,
-                    question_map[q_num],
-                    correct_answers[q_num],
-                    distractors[q_num],
-                    request
-                ): q_num for q_num in distractors.keys()
-            }
-            
-            for future in as_completed(future_to_question_num):
-                question_num = future_to_question_num[future]
-                try:
-                    explanations[question_num] = future.result()
-                except Exception as e:
-                    print(f"Error generating explanations for question {question_num}: {str(e)}")
-                    raise
-        
-        # Format all MCQs
-        question_bank = []
-        for q_num in sorted(question_map.keys()):  # Sort by question number
-            try:
-                mcq = format_mcq(
-                    question=question_map[q_num],
-                    correct_answer=correct_answers[q_num],
-                    distractors=distractors[q_num],
-                    explanations=explanations[q_num]
-                )
-                question_bank.append(mcq)
-            except Exception as e:
-                print(f"Error formatting MCQ for question {q_num}: {str(e)}")
+# Async callback that receives pipeline progress events (plain JSON-able dicts)
+EventCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+
+async def emit_event(on_event: Optional[EventCallback], event: str, **fields):
+    """Send a progress event to on_event, if one was given"""
+    if on_event is not None:
+        await on_event({"event": event, **fields})
+
+async def resolved(value: Any) -> Any:
+    """An awaitable that returns value, for stages whose output is already known"""
+    return value
+
+@contextmanager
+def stage_timer(stage: str, difficulty: Optional[int]):
+    """Record the wall time of a pipeline stage in metrics and the request timings"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        metrics.observe("mcq_stage_seconds", metric_labels(stage, difficulty), elapsed)
+        timings = current_request_timings.get()
+        if timings is not None:
+            timings.record_stage(stage, elapsed)
+
+async def run_checkpointed_stage(checkpoint: Optional["JobCheckpoint"], stage: str,
+                                 key: Any, produce: Callable[[], Awaitable[Any]],
+                                 parse: Callable[[Any], Any],
+                                 difficulty: Optional[int] = None) -> Any:
+    """Return the saved output of a stage if there is one, otherwise produce and save it"""
+    if checkpoint is not None:
+        saved = checkpoint.get(stage, key)
+        if saved is not None:
+            return parse(saved)
+    with stage_timer(stage, difficulty):
+        value = await produce()
+    if checkpoint is not None:
+        await checkpoint.save(stage, key, value)
+    return value
+
+async def generate_mcq_chain(question: Question, 
+                             request_data: QuestionRequest,
+                             on_event: Optional[EventCallback] = None,
+                             checkpoint: Optional["JobCheckpoint"] = None) -> MCQuestion:
+    """Run one question through correct answer -> distractors -> explanations.
+
+    In fused mode the three stages come from a single call when it succeeds.
+    """
+    question_num = question.question_number
+    fused = None
+    if GENERATION_MODE == "fused" and (
+            checkpoint is None or checkpoint.get("correct_answer", question_num) is None):
+        with stage_timer("fused", question.difficulty):
+            fused = await generate_fused_options(question, request_data)
+    try:
+        correct_answer = await run_checkpointed_stage(
+            checkpoint, "correct_answer", question_num,
+            (lambda: resolved(fused[0])) if fused else
+            (lambda: generate_checked_correct_answer(question, request_data)), str,
+            question.difficulty)
+    except Exception as e:
+        print(f"Error generating correct answer for question {question_num}: {str(e)}")
+        raise
+    await emit_event(on_event, "stage", stage="correct_answer",
+                     question_number=question_num, difficulty=question.difficulty)
+    try:
+        distractors = await run_checkpointed_stage(
+            checkpoint, "distractors", question_num,
+            (lambda: resolved(fused[1])) if fused else
+            (lambda: generate_checked_distractors(question, correct_answer, request_data)),
+            lambda saved: Distractors(**saved), question.difficulty)
+    except Exception as e:
+        print(f"Error generating distractors for question {question_num}: {str(e)}")
+        raise
+    await emit_event(on_event, "stage", stage="distractors",
+                     question_number=question_num, difficulty=question.difficulty)
+    try:
+        explanations = await run_checkpointed_stage(
+            checkpoint, "explanations", question_num,
+            (lambda: resolved(fused[2])) if fused else
+            (lambda: generate_explanations(
+                question, correct_answer, distractors, request_data)),
+            lambda saved: Explanations(**saved), question.difficulty)
+    except Exception as e:
+        print(f"Error generating explanations for question {question_num}: {str(e)}")
+        raise
+    await emit_event(on_event, "stage", stage="explanations",
+                     question_number=question_num, difficulty=question.difficulty)
+    async def build_mcq():
+        return format_mcq(
+            question=question,
+            correct_answer=correct_answer,
+            distractors=distractors,
+            explanations=explanations
+        )
+
+    try:
+        # Saved so that a resumed job keeps the same answer order
+        mcq = await run_checkpointed_stage(
+            checkpoint, "mcq", question_num, build_mcq,
+            lambda saved: MCQuestion(**saved), question.difficulty)
+    except Exception as e:
+        print(f"Error formatting MCQ for question {question_num}: {str(e)}")
+        raise
+    await emit_event(on_event, "question", question_number=question_num,
+                     question=mcq.dict())
+    return mcq
+
+async def generate_mcq_chain_with_recovery(question: Question,
+                                           request_data: QuestionRequest,
+                                           on_event: Optional[EventCallback] = None,
+                                           checkpoint: Optional["JobCheckpoint"] = None
+                                           ) -> MCQuestion:
+    """Run a question's chain, regenerating only that chain if it fails.
+
+    Stages that already succeeded come back from the LLM cache or the
+    checkpoint, so in practice only the failed stage is called again.
+    """
+    while True:
+        try:
+            return await generate_mcq_chain(question, request_data, on_event, checkpoint)
+        except (LLMCallError, ValueError) as e:
+            if isinstance(e, LLMCallError) and not e.retryable:
+                raise
+            if not take_retry():
                 raise
+            metrics.inc("mcq_chain_regenerations_total",
+                        {"difficulty": question.difficulty})
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            await emit_event(on_event, "retry", question_number=question.question_number,
+                             detail=detail)
 
-        # Verify final question bank has 6 questions
-        if len(question_bank) != 6:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Final question bank has {len(question_bank)} questions instead of 6"
-            )
-        
-        return QuestionBankResponse(questionBank=question_bank)
-        
+def bank_shortfall(request: QuestionRequest,
+                   question_bank: List[MCQuestion]) -> Dict[int, Dict[str, int]]:
+    """Questions missing from a bank per difficulty (empty if it is complete)"""
+    have = Counter(q.difficulty for q in question_bank)
+    return {difficulty: {"requested": count, "missing": count - have[difficulty]}
+            for difficulty, count in question_plan(request).items()
+            if have[difficulty] < count}
+
+async def run_question_bank_pipeline(request: QuestionRequest,
+                                     on_event: Optional[EventCallback] = None,
+                                     checkpoint: Optional["JobCheckpoint"] = None
+                                     ) -> List[MCQuestion]:
+    """Generate the full question bank, sorted by question number.
+
+    Each question moves to its next stage as soon as its own previous stage
+    finishes, instead of waiting for every question to clear each stage;
+    that includes the question set, whose batches start their questions'
+    chains as each batch returns.
+    Questions are numbered globally: difficulty 1 first, then 2, then 3.
+    With a checkpoint, stages that already have saved output are skipped.
+    """
+    plan = question_plan(request)
+    requested = sum(plan.values())
+    
+    question_bank_map = {}
+    accepted_questions: List[str] = []
+    # BANK_RETRY_BUDGET is per default-sized bank; larger banks get proportionally more
+    current_retry_budget.set(RetryBudget(math.ceil(
+        BANK_RETRY_BUDGET * requested / sum(DEFAULT_QUESTIONS_PER_DIFFICULTY.values()))))
+    current_llm_flow.set(uuid.uuid4().hex)
+    retrieval_stats = RetrievalStats()
+    current_retrieval_stats.set(retrieval_stats)
+    question_set_errors: List[Exception] = []
+    
+    async def run_difficulty(diff: int):
+        count = plan[diff]
+        if count == 0:
+            return
+        offset = sum(plan[d] for d in plan if d < diff)
+        # Saved after every batch, so a resumed job keeps the questions (and
+        # numbers) it already has and only tops up the rest
+        saved = checkpoint.get("question_set", diff) if checkpoint is not None else None
+        questions: List[Question] = []
+        chains: List[asyncio.Task] = []
+
+        async def run_chain(question: Question):
+            question_bank_map[question.question_number] = (
+                await generate_mcq_chain_with_recovery(question, request, on_event, checkpoint))
+
+        async def start_chains(numbered: List[Question]):
+            questions.extend(numbered)
+            # Start answering these questions right away
+            await emit_event(on_event, "stage", stage="question_set", difficulty=diff,
+                             question_numbers=[q.question_number for q in numbered])
+            chains.extend(asyncio.ensure_future(run_chain(q)) for q in numbered)
+
+        async def on_questions(new_questions: List[Question]):
+            numbered = update_question_numbers(new_questions, diff, offset + len(questions))
+            if checkpoint is not None:
+                await checkpoint.save("question_set", diff, questions + numbered)
+            await start_chains(numbered)
+
+        try:
+            if saved:
+                restored = [Question(**q) for q in saved]
+                accepted_questions.extend(q.question_text for q in restored
+                                          if q.question_text not in accepted_questions)
+                await start_chains(restored)
+            if len(questions) < count:
+                try:
+                    with stage_timer("question_set", diff):
+                        await generate_unique_question_set(
+                            diff, request, accepted_questions, count - len(questions),
+                            on_questions=on_questions)
+                except (LLMCallError, ValueError) as e:
+                    if not is_shortfall_error(e):
+                        raise
+                    # A shortfall for the bank; the other difficulties carry on
+                    print(f"No questions could be written at difficulty {diff}: {str(e)}")
+                    question_set_errors.append(e)
+            await gather_or_cancel(*chains)
+        except BaseException:
+            for chain in chains:
+                chain.cancel()
+            raise
+    
+    await gather_or_cancel(
+        *(run_difficulty(diff) for diff in plan))
+
+    retrieval = retrieval_stats.summary()
+    metrics.inc("mcq_article_tokens_total", {"kind": "full"}, retrieval["full_article_tokens"])
+    metrics.inc("mcq_article_tokens_total", {"kind": "sent"}, retrieval["sent_article_tokens"])
+    timings = current_request_timings.get()
+    if timings is not None:
+        timings.record_retrieval(retrieval)
+    await emit_event(on_event, "retrieval", **retrieval)
+
+    if not question_bank_map:
+        if question_set_errors:
+            raise question_set_errors[0]
+        raise HTTPException(status_code=500, detail="No questions could be generated")
+    # Sort by question number
+    question_bank = [question_bank_map[q_num] for q_num in sorted(question_bank_map.keys())]
+    shortfall = bank_shortfall(request, question_bank)
+    for difficulty, counts in shortfall.items():
+        metrics.inc("mcq_missing_questions_total", {"difficulty": difficulty}, counts["missing"])
+    if shortfall:
+        # Reported to callers through bank_shortfall (response, stream summary, job)
+        print(f"Question bank has {len(question_bank)} of {requested} requested questions")
+    return question_bank
+
+def edit_target(edit: QuestionEditRequest) -> MCQuestion:
+    """The question an edit applies to; raises a 400 for an invalid edit"""
+    if edit.operation not in EDIT_OPERATIONS:
+        raise HTTPException(status_code=400,
+                            detail=f"operation must be one of {list(EDIT_OPERATIONS)}, "
+                                   f"got {edit.operation!r}")
+    if not 1 <= edit.question_number <= len(edit.bank.questionBank):
+        raise HTTPException(status_code=400,
+                            detail=f"question_number must be between 1 and "
+                                   f"{len(edit.bank.questionBank)}, got {edit.question_number}")
+    mcq = edit.bank.questionBank[edit.question_number - 1]
+    if mcq.difficulty not in (1, 2, 3):
+        raise HTTPException(status_code=400,
+                            detail=f"Question {edit.question_number} has difficulty "
+                                   f"{mcq.difficulty}; expected 1, 2 or 3")
+    if edit.operation != "replace_question":
+        bank_options(mcq, edit.question_number)
+    return mcq
+
+def bank_options(mcq: MCQuestion, question_number: int) -> Tuple[str, Distractors]:
+    """The correct answer and distractors of a bank question, distractors in
+    the order they appear; raises a 400 unless there are 1 correct and 3 wrong"""
+    correct = [r.label for r in mcq.responses if r.isCorrect]
+    wrong = [r.label for r in mcq.responses if not r.isCorrect]
+    if len(correct) != 1 or len(wrong) != 3:
+        raise HTTPException(status_code=400,
+                            detail=f"Question {question_number} must have 1 correct and "
+                                   f"3 incorrect responses")
+    return correct[0], Distractors(**{f"d{i}": DistractorResponse(response_text=text)
+                                      for i, text in enumerate(wrong, 1)})
+
+def replace_options(mcq: MCQuestion, correct_answer: str, distractors: Distractors,
+                    explanations: Explanations) -> MCQuestion:
+    """Rewrite a bank question's options in place, keeping their order"""
+    keys = iter(("d1", "d2", "d3"))
+    responses = []
+    for response in mcq.responses:
+        if response.isCorrect:
+            responses.append(MCQResponse(label=correct_answer, isCorrect=True,
+                                         explanation=explanations.correct_answer_explanation))
+        else:
+            key = next(keys)
+            responses.append(MCQResponse(
+                label=getattr(distractors, key).response_text, isCorrect=False,
+                explanation=getattr(explanations.distractor_explanations, key).explanation))
+    return MCQuestion(material=mcq.material, responses=responses, difficulty=mcq.difficulty)
+
+async def edit_question_bank(edit: QuestionEditRequest) -> List[MCQuestion]:
+    """Apply a targeted edit to one question of a bank and return the whole bank.
+
+    Only the stages downstream of the edit run again (see EDIT_OPERATIONS);
+    every other question, and the edited question's upstream stages, are
+    returned as they were.
+    """
+    mcq = edit_target(edit)
+    request = edit.request
+    index = edit.question_number - 1
+    bank = list(edit.bank.questionBank)
+    # BANK_RETRY_BUDGET is per default-sized bank; an edit touches one question
+    current_retry_budget.set(RetryBudget(math.ceil(
+        BANK_RETRY_BUDGET / sum(DEFAULT_QUESTIONS_PER_DIFFICULTY.values()))))
+    current_llm_flow.set(uuid.uuid4().hex)
+    # Asking again must not return the cached answer to the same prompt
+    current_llm_cache_bypass.set(True)
+
+    if edit.operation == "replace_question":
+        others = [q.material for i, q in enumerate(bank) if i != index]
+        with stage_timer("question_set", mcq.difficulty):
+            questions = await generate_unique_question_set(
+                mcq.difficulty, request, others, 1, avoid=[mcq.material],
+                feedback=edit.feedback)
+        if not questions:
+            raise HTTPException(status_code=500,
+                                detail="No replacement question could be generated")
+        question = update_question_numbers(questions, mcq.difficulty, index)[0]
+        bank[index] = await generate_mcq_chain_with_recovery(question, request)
+        return bank
+
+    # The bank does not keep a question's EK/LO code or task verb; they only
+    # steer passage retrieval, so the request's codes stand in for them
+    question = Question(question_number=edit.question_number, question_text=mcq.material,
+                        ek_code_specific_to_this_question=request.ek_codes,
+                        lo_code_specific_to_this_question=request.lo_codes,
+                        task_verb="", difficulty=mcq.difficulty)
+    correct_answer, distractors = bank_options(mcq, edit.question_number)
+    explanation_feedback = ""
+    if edit.operation == "regenerate_distractors":
+        rejected = "; ".join(getattr(distractors, key).response_text
+                             for key in ("d1", "d2", "d3"))
+        feedback = f"Write new distractors, different from these: {rejected}. {edit.feedback}"
+        with stage_timer("distractors", mcq.difficulty):
+            distractors = await generate_checked_distractors(
+                question, correct_answer, request, feedback.strip())
+    else:
+        if edit.correct_answer:
+            correct_answer = edit.correct_answer
+        rejected = " ".join(r.explanation for r in mcq.responses)
+        explanation_feedback = (f"Write new explanations, different from these: {rejected} "
+                                f"{edit.feedback}").strip()
+    with stage_timer("explanations", mcq.difficulty):
+        explanations = await generate_explanations(
+            question, correct_answer, distractors, request, explanation_feedback)
+    bank[index] = replace_options(mcq, correct_answer, distractors, explanations)
+    return bank
+
+def start_request_timings() -> RequestTimings:
+    """Collect a timing breakdown for the pipeline run in the current context"""
+    timings = RequestTimings()
+    current_request_timings.set(timings)
+    return timings
+
+def record_request(endpoint: str, status: str, started: float):
+    metrics.inc("mcq_requests_total", {"endpoint": endpoint, "status": status})
+    metrics.observe("mcq_request_seconds", {"endpoint": endpoint},
+                    time.monotonic() - started)
+
+# Identical requests (same article, question bank, EK and LO codes after
+# whitespace normalization) share one pipeline run while it is in flight, and
+# its result for REQUEST_COALESCE_WINDOW_SECONDS after it completes.
+REQUEST_COALESCING = os.getenv("REQUEST_COALESCING", "1").lower() in ("1", "true", "yes", "on")
+REQUEST_COALESCE_WINDOW_SECONDS = float(os.getenv("REQUEST_COALESCE_WINDOW_SECONDS", "10"))
+
+def request_key(request: QuestionRequest) -> str:
+    """Hash of the request fields that determine the question bank"""
+    payload = json.dumps([" ".join(field.split()) for field in (
+        request.article, request.current_question_bank, request.ek_codes, request.lo_codes)]
+        + [sorted(request.questions_per_difficulty.items())],
+        ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class GenerationFlight:
+    """One pipeline run, shared by every request attached to it.
+
+    Progress events are kept so that a stream attaching late first replays
+    what it missed. Listener queues receive None once the run is over.
+    """
+
+    def __init__(self, request: QuestionRequest):
+        self.events: List[Dict[str, Any]] = []
+        self.listeners: List[asyncio.Queue] = []
+        self.subscribers = 0
+        self.finished_at: Optional[float] = None
+        self.timings = RequestTimings()
+        self.task = asyncio.ensure_future(self._run(request))
+        self.task.add_done_callback(self._finish)
+
+    async def _run(self, request: QuestionRequest) -> List[MCQuestion]:
+        current_request_timings.set(self.timings)
+        return await run_question_bank_pipeline(request, self._publish)
+
+    async def _publish(self, event: Dict[str, Any]):
+        self.events.append(event)
+        for queue in self.listeners:
+            queue.put_nowait(event)
+
+    def _finish(self, task: asyncio.Future):
+        self.finished_at = time.monotonic()
+        for queue in self.listeners:
+            queue.put_nowait(None)
+
+    @property
+    def succeeded(self) -> bool:
+        return self.task.done() and not self.task.cancelled() and self.task.exception() is None
+
+    def listen(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        for event in self.events:
+            queue.put_nowait(event)
+        if self.task.done():
+            queue.put_nowait(None)
+        else:
+            self.listeners.append(queue)
+        return queue
+
+    def stop_listening(self, queue: asyncio.Queue):
+        if queue in self.listeners:
+            self.listeners.remove(queue)
+
+class RequestCoalescer:
+    """Single-flight map from request key to the pipeline run serving it"""
+
+    def __init__(self, enabled: bool, window_seconds: float):
+        self.enabled = enabled
+        self.window_seconds = window_seconds
+        self._flights: Dict[str, GenerationFlight] = {}
+
+    def _expire(self):
+        now = time.monotonic()
+        for key, flight in list(self._flights.items()):
+            if flight.finished_at is not None and (
+                    not flight.succeeded or now - flight.finished_at > self.window_seconds):
+                del self._flights[key]
+
+    def join(self, request: QuestionRequest) -> Tuple[GenerationFlight, bool]:
+        """The flight serving this request, and whether it was already running"""
+        self._expire()
+        key = request_key(request)
+        flight = self._flights.get(key) if self.enabled else None
+        coalesced = flight is not None
+        if flight is None:
+            flight = GenerationFlight(request)
+            if self.enabled:
+                self._flights[key] = flight
+        flight.subscribers += 1
+        return flight, coalesced
+
+    def leave(self, flight: GenerationFlight):
+        """Detach a request; a run nobody is waiting for any more is cancelled"""
+        flight.subscribers -= 1
+        if flight.subscribers <= 0 and not flight.task.done():
+            flight.task.cancel()
+
+    def stats(self) -> Dict[str, int]:
+        self._expire()
+        running = sum(1 for f in self._flights.values() if f.finished_at is None)
+        return {"running": running, "completed": len(self._flights) - running}
+
+request_coalescer = RequestCoalescer(REQUEST_COALESCING, REQUEST_COALESCE_WINDOW_SECONDS)
+
+@app.post("/generate-questions", response_model=QuestionBankResponse,
+          response_model_exclude_none=True)
+async def generate_question_bank(request: QuestionRequest, response: Response,
+                                 debug: bool = False):
+    """Main API endpoint to generate question bank.
+
+    The Server-Timing header breaks the request down by stage; with
+    debug=true the full breakdown (LLM time, calls, retries, tokens) is
+    added to the body as well.
+    """
+    started = time.monotonic()
+    question_plan(request)
+    flight, coalesced = request_coalescer.join(request)
+    if coalesced:
+        metrics.inc("mcq_coalesced_requests_total", {"endpoint": "generate-questions"})
+    try:
+        # Shielded: this client going away must not cancel the run for others
+        question_bank = await asyncio.shield(flight.task)
+    except Exception as e:
+        record_request("generate-questions", "failed", started)
+        raise HTTPException(status_code=500, detail=str(e),
+                            headers={"Server-Timing": flight.timings.server_timing()})
+    finally:
+        request_coalescer.leave(flight)
+    record_request("generate-questions", "completed", started)
+    response.headers["Server-Timing"] = flight.timings.server_timing()
+    debug_info = {"timings": flight.timings.summary(), "coalesced": coalesced}
+    return QuestionBankResponse(questionBank=question_bank,
+                                shortfall=bank_shortfall(request, question_bank) or None,
+                                debug=debug_info if debug else None)
+
+def format_stream_event(event: Dict[str, Any], stream_format: str) -> str:
+    """Serialize an event as an NDJSON line or a server-sent event"""
+    data = json.dumps(event)
+    if stream_format == "sse":
+        return f"event: {event['event']}\ndata: {data}\n\n"
+    return data + "\n"
+
+async def stream_pipeline_events(request: QuestionRequest,
+                                 stream_format: str) -> AsyncIterator[str]:
+    """Yield the events of the pipeline run serving this request as they happen.
+
+    A request identical to one already running attaches to that run and
+    first receives the events it has emitted so far.
+    """
+    started = time.monotonic()
+    flight, coalesced = request_coalescer.join(request)
+    if coalesced:
+        metrics.inc("mcq_coalesced_requests_total", {"endpoint": "generate-questions-stream"})
+    queue = flight.listen()
+    try:
+        while True:
+            event = await queue.get()
+            if event is None:
+                break
+            yield format_stream_event(event, stream_format)
+        summary = {"event": "summary", "coalesced": coalesced}
+        if flight.succeeded:
+            record_request("generate-questions-stream", "completed", started)
+            question_bank = flight.task.result()
+            shortfall = bank_shortfall(request, question_bank)
+            summary.update(status="partial" if shortfall else "completed",
+                           question_count=len(question_bank))
+            if shortfall:
+                summary.update(shortfall=shortfall)
+        else:
+            record_request("generate-questions-stream", "failed", started)
+            error = None if flight.task.cancelled() else flight.task.exception()
+            summary.update(status="failed",
+                           detail=error.detail if isinstance(error, HTTPException)
+                           else str(error or "Generation was cancelled"))
+        summary.update(elapsed_seconds=round(time.monotonic() - started, 3),
+                       timings=flight.timings.summary())
+        yield format_stream_event(summary, stream_format)
+    finally:
+        # Client went away or stream finished: stop the run if nobody else needs it
+        flight.stop_listening(queue)
+        request_coalescer.leave(flight)
+
+@app.post("/generate-questions/stream")
+async def generate_question_bank_stream(request: QuestionRequest,
+                                        format: str = "ndjson"):
+    """Streaming variant of /generate-questions.
+
+    Emits progress events per stage per question, each MCQuestion as soon as
+    it is ready, and a final summary record. format is "ndjson" or "sse".
+    """
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400,
+                            detail="format must be 'ndjson' or 'sse'")
+    question_plan(request)
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream_pipeline_events(request, format),
+                             media_type=media_type)
+
+@app.post("/edit-question", response_model=QuestionBankResponse,
+          response_model_exclude_none=True)
+async def edit_question(edit: QuestionEditRequest, response: Response, debug: bool = False):
+    """Apply one targeted edit to an existing bank, re-running only the
+    stages that depend on it. Returns the whole bank with that question
+    updated; Server-Timing and debug work as for /generate-questions.
+    """
+    started = time.monotonic()
+    edit_target(edit)
+    timings = start_request_timings()
+    try:
+        question_bank = await edit_question_bank(edit)
+    except Exception as e:
+        record_request("edit-question", "failed", started)
+        raise HTTPException(status_code=500, detail=str(e),
+                            headers={"Server-Timing": timings.server_timing()})
+    record_request("edit-question", "completed", started)
+    response.headers["Server-Timing"] = timings.server_timing()
+    debug_info = {"timings": timings.summary(), "operation": edit.operation,
+                  "stages": list(EDIT_OPERATIONS[edit.operation])}
+    return QuestionBankResponse(questionBank=question_bank,
+                                debug=debug_info if debug else None)
+
+@app.get("/llm/controller")
+def llm_controller_stats():
+    """Current concurrency window, in-flight calls and queue depth of the LLM controller"""
+    return {**llm_controller.stats(),
+            "hedging": hedge_budget.stats(),
+            "stage_latencies": stage_latencies.stats()}
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Hit/miss counters and sizes of the LLM response cache"""
+    cache = get_llm_cache()
+    if cache is None:
+        return {"mode": LLM_CACHE_MODE}
+    return {"mode": LLM_CACHE_MODE, **cache.stats()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Prometheus metrics: per-stage LLM latency, tokens, retries, failures and controller state"""
+    controller = llm_controller.stats()
+    metrics.set("mcq_llm_concurrency_window", None, controller["window"])
+    metrics.set("mcq_llm_in_flight", None, controller["in_flight"])
+    metrics.set("mcq_llm_queue_depth", None, controller["queue_depth"])
+    metrics.set("mcq_llm_hedges_total", None, hedge_budget.counters["hedges"])
+    for state, count in request_coalescer.stats().items():
+        metrics.set("mcq_shared_generations", {"state": state}, count)
+    cache = get_llm_cache()
+    if cache is not None:
+        cache = cache.stats()
+        for result in ("memory_hits", "disk_hits", "misses"):
+            metrics.set("mcq_llm_cache_lookups_total", {"result": result}, cache[result])
+    return PlainTextResponse(metrics.render(),
+                             media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Asynchronous jobs: persistent, resumable question bank generation
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+class JobStore:
+    """SQLite store for jobs and the per-question stage outputs they have produced"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                   id TEXT PRIMARY KEY,
+                   status TEXT NOT NULL,
+                   request TEXT NOT NULL,
+                   result TEXT,
+                   error TEXT,
+                   created_at REAL NOT NULL,
+                   updated_at REAL NOT NULL);
+               CREATE TABLE IF NOT EXISTS job_stages (
+                   job_id TEXT NOT NULL,
+                   stage TEXT NOT NULL,
+                   key TEXT NOT NULL,
+                   payload TEXT NOT NULL,
+                   PRIMARY KEY (job_id, stage, key));""")
+        self._conn.commit()
+
+    def create(self, request: QuestionRequest) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, request, created_at, updated_at) "
+                "VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, request.json(), now, now))
+            self._conn.commit()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, request, result, error, created_at, updated_at "
+                "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        keys = ("id", "status", "request", "result", "error", "created_at", "updated_at")
+        return dict(zip(keys, row))
+
+    def set_status(self, job_id: str, status: str, result: Optional[str] = None,
+                   error: Optional[str] = None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? "
+                "WHERE id = ?",
+                (status, result, error, time.time(), job_id))
+            self._conn.commit()
+
+    def unfinished_job_ids(self) -> List[str]:
+        """Jobs that were queued or running when the process last stopped"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') "
+                "ORDER BY created_at").fetchall()
+        return [row[0] for row in rows]
+
+    def load_stages(self, job_id: str) -> Dict[tuple, Any]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stage, key, payload FROM job_stages WHERE job_id = ?",
+                (job_id,)).fetchall()
+        return {(stage, key): json.loads(payload) for stage, key, payload in rows}
+
+    def save_stage(self, job_id: str, stage: str, key: str, payload: Any):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_stages (job_id, stage, key, payload) "
+                "VALUES (?, ?, ?, ?)",
+                (job_id, stage, key, json.dumps(payload)))
+            self._conn.execute(
+                "UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time(), job_id))
+            self._conn.commit()
+
+class JobCheckpoint:
+    """Stage outputs of one job, loaded from and written through to the job store"""
+
+    def __init__(self, store: JobStore, job_id: str):
+        self.store = store
+        self.job_id = job_id
+        self.stages = store.load_stages(job_id)
+
+    def get(self, stage: str, key: Any) -> Optional[Any]:
+        return self.stages.get((stage, str(key)))
+
+    async def save(self, stage: str, key: Any, value: Any):
+        payload = jsonable_encoder(value)
+        self.stages[(stage, str(key))] = payload
+        await asyncio.to_thread(
+            self.store.save_stage, self.job_id, stage, str(key), payload)
+
+class JobCreatedResponse(BaseModel):
+    job_id: str
+    status: str
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    created_at: float
+    updated_at: float
+    progress: Dict[str, int]
+    questionBank: List[MCQuestion]
+    shortfall: Optional[Dict[int, Dict[str, int]]] = None
+    error: Optional[str] = None
+
+# Opened by the startup hook so that importing the module creates no files
+job_store: Optional[JobStore] = None
+job_queue: Optional[asyncio.Queue] = None
+job_workers: List[asyncio.Task] = []
+
+async def process_job(job_id: str):
+    """Run (or resume) one job, skipping every stage it already completed"""
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        return
+    await asyncio.to_thread(job_store.set_status, job_id, "running")
+    request = QuestionRequest(**json.loads(job["request"]))
+    checkpoint = await asyncio.to_thread(JobCheckpoint, job_store, job_id)
+    timings = start_request_timings()
+    try:
+        question_bank = await run_question_bank_pipeline(request, checkpoint=checkpoint)
+        shortfall = bank_shortfall(request, question_bank)
+        result = QuestionBankResponse(questionBank=question_bank,
+                                      shortfall=shortfall or None).json(exclude_none=True)
+        if shortfall:
+            # Resumable: only the missing questions are generated again
+            missing = sum(counts["missing"] for counts in shortfall.values())
+            await asyncio.to_thread(
+                job_store.set_status, job_id, "partial", result,
+                f"{missing} of {sum(question_plan(request).values())} requested "
+                f"questions could not be generated")
+            record_request("jobs", "partial", timings.started)
+        else:
+            await asyncio.to_thread(job_store.set_status, job_id, "completed", result)
+            record_request("jobs", "completed", timings.started)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        record_request("jobs", "failed", timings.started)
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        print(f"Error processing job {job_id}: {detail}")
+        await asyncio.to_thread(job_store.set_status, job_id, "failed", None, detail)
+
+async def job_worker():
+    while True:
+        job_id = await job_queue.get()
+        try:
+            await process_job(job_id)
+        finally:
+            job_queue.task_done()
+
+@app.on_event("startup")
+async def start_job_workers():
+    """Start the worker pool and requeue jobs interrupted by the last shutdown"""
+    global job_queue, job_store
+    if job_store is None:
+        job_store = await asyncio.to_thread(JobStore, JOB_STORE_PATH)
+    job_queue = asyncio.Queue()
+    for job_id in await asyncio.to_thread(job_store.unfinished_job_ids):
+        job_queue.put_nowait(job_id)
+    for _ in range(JOB_WORKERS):
+        job_workers.append(asyncio.ensure_future(job_worker()))
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    for worker in job_workers:
+        worker.cancel()
+    job_workers.clear()
+
+@app.post("/jobs", response_model=JobCreatedResponse, status_code=202)
+async def create_job(request: QuestionRequest):
+    """Queue a question bank generation job"""
+    question_plan(request)
+    job_id = await asyncio.to_thread(job_store.create, request)
+    await job_queue.put(job_id)
+    return JobCreatedResponse(job_id=job_id, status="queued")
+
+@app.get("/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job(job_id: str):
+    """Status of a job, with every question completed so far"""
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    stages = await asyncio.to_thread(job_store.load_stages, job_id)
+    shortfall = None
+    if job["result"] is not None:
+        result = QuestionBankResponse(**json.loads(job["result"]))
+        question_bank, shortfall = result.questionBank, result.shortfall
+    else:
+        question_bank = [MCQuestion(**payload) for (stage, key), payload
+                         in sorted(stages.items(), key=lambda item: int(item[0][1]))
+                         if stage == "mcq"]
+    progress = {}
+    for stage, _ in stages:
+        progress[stage] = progress.get(stage, 0) + 1
+    return JobStatusResponse(
+        job_id=job_id,
+        status=job["status"],
+        created_at=job["created_at"],
+        updated_at=job["updated_at"],
+        progress=progress,
+        questionBank=question_bank,
+        shortfall=shortfall,
+        error=job["error"]
+    )
+
+@app.post("/jobs/{job_id}/resume", response_model=JobCreatedResponse, status_code=202)
+async def resume_job(job_id: str):
+    """Requeue a failed or partial job; it continues from its last completed stages"""
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    if job["status"] not in ("failed", "partial"):
+        raise HTTPException(status_code=409,
+                            detail=f"Job {job_id} is {job['status']}, only failed or partial "
+                                   f"jobs can be resumed")
+    await asyncio.to_thread(job_store.set_status, job_id, "queued")
+    await job_queue.put(job_id)
+    return JobCreatedResponse(job_id=job_id, status="queued")
 
 if __name__ == "__main__":
     import uvicorn
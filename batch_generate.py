@@ -0,0 +1,159 @@
+"""Offline bulk generation of question banks from a JSONL file.
+
+Each input line is a QuestionRequest JSON object (an optional "id" field is
+copied to the output). Each finished bank is appended to the output JSONL as
+soon as it is ready. The byte offset of every completed input line is
+appended to a checkpoint file, so an interrupted run can be restarted with the
+same arguments without paying for finished lines again.
+
+    python batch_generate.py articles.jsonl banks.jsonl --workers 8 --calls-per-minute 300
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+class SharedRateLimiter:
+    """Token bucket of OpenAI calls per minute shared by every worker process"""
+
+    def __init__(self, calls_per_minute: float, ctx):
+        self.rate = calls_per_minute / 60.0
+        self.capacity = max(1.0, self.rate)
+        self._lock = ctx.Lock()
+        self._tokens = ctx.Value("d", self.capacity, lock=False)
+        self._updated = ctx.Value("d", time.time(), lock=False)
+
+    def _take(self) -> float:
+        """Take a token if one is available; otherwise return the seconds to wait"""
+        with self._lock:
+            now = time.time()
+            self._tokens.value = min(
+                self.capacity, self._tokens.value + (now - self._updated.value) * self.rate)
+            self._updated.value = now
+            if self._tokens.value >= 1:
+                self._tokens.value -= 1
+                return 0.0
+            return (1 - self._tokens.value) / self.rate
+
+    async def acquire(self):
+        while True:
+            delay = self._take()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+# Per-process state, set up by init_worker
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+_api = None
+
+def init_worker(rate_limiter: Optional[SharedRateLimiter]):
+    """Import the API once per process and give it a long-lived event loop"""
+    global _worker_loop, _api
+    import ap_mcq_generation_api as api
+    api.llm_rate_limiter = rate_limiter
+    _api = api
+    _worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_worker_loop)
+
+def generate_record(offset: int, line: str) -> Tuple[int, Optional[str], Optional[str]]:
+    """Generate one bank; returns (offset, output JSON line, error)"""
+    try:
+        record = json.loads(line)
+        request = _api.QuestionRequest(**record)
+        question_bank = _worker_loop.run_until_complete(
+            _api.run_question_bank_pipeline(request))
+        output = {"offset": offset}
+        if "id" in record:
+            output["id"] = record["id"]
+        output.update(_api.QuestionBankResponse(
+            questionBank=question_bank,
+            shortfall=_api.bank_shortfall(request, question_bank) or None).dict(exclude_none=True))
+        return offset, json.dumps(output), None
+    except Exception as e:
+        detail = getattr(e, "detail", None) or str(e)
+        return offset, None, detail
+
+def read_checkpoint(path: str) -> Set[int]:
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {int(line) for line in f if line.strip()}
+
+def iter_records(path: str, done: Set[int]) -> Iterator[Tuple[int, str]]:
+    """Yield (byte offset, line) for every non-empty input line not yet completed"""
+    with open(path, "rb") as f:
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                return
+            if line.strip() and offset not in done:
+                yield offset, line.decode("utf-8")
+
+def run_batch(input_path: str, output_path: str, checkpoint_path: str,
+              workers: int, calls_per_minute: Optional[float]) -> Dict[str, int]:
+    done = read_checkpoint(checkpoint_path)
+    ctx = multiprocessing.get_context("spawn")
+    rate_limiter = SharedRateLimiter(calls_per_minute, ctx) if calls_per_minute else None
+    counts = {"skipped": len(done), "completed": 0, "failed": 0}
+    records = iter_records(input_path, done)
+
+    with open(output_path, "a") as output, open(checkpoint_path, "a") as checkpoint, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                initializer=init_worker, initargs=(rate_limiter,)) as pool:
+        pending = set()
+
+        def fill():
+            # Keep a bounded number of records in flight so huge inputs are streamed
+            while len(pending) < workers * 2:
+                record = next(records, None)
+                if record is None:
+                    return
+                pending.add(pool.submit(generate_record, *record))
+
+        fill()
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                pending.discard(future)
+                offset, line, error = future.result()
+                if error is not None:
+                    counts["failed"] += 1
+                    print(f"Line at offset {offset} failed: {error}", file=sys.stderr)
+                    continue
+                # Output first, then checkpoint: a crash in between repeats one
+                # line on resume rather than losing it
+                output.write(line + "\n")
+                output.flush()
+                checkpoint.write(f"{offset}\n")
+                checkpoint.flush()
+                counts["completed"] += 1
+                print(f"Completed offset {offset} ({counts['completed']} done, "
+                      f"{counts['failed']} failed)", file=sys.stderr)
+            fill()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate question banks for every QuestionRequest in a JSONL file")
+    parser.add_argument("input", help="JSONL file of QuestionRequest records")
+    parser.add_argument("output", help="JSONL file that QuestionBankResponse records are appended to")
+    parser.add_argument("--checkpoint", help="File of completed input offsets (default: OUTPUT.checkpoint)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2,
+                        help="Worker processes, each generating one bank at a time")
+    parser.add_argument("--calls-per-minute", type=float, default=None,
+                        help="OpenAI calls per minute across all workers (default: unlimited)")
+    args = parser.parse_args()
+
+    counts = run_batch(args.input, args.output, args.checkpoint or args.output + ".checkpoint",
+                       args.workers, args.calls_per_minute)
+    print(f"Done: {counts['completed']} completed, {counts['failed']} failed, "
+          f"{counts['skipped']} already completed", file=sys.stderr)
+    sys.exit(1 if counts["failed"] else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Compare staged and fused generation: latency, OpenAI calls and tokens per bank.
+
+Runs against whatever endpoint the API is configured for (OPENAI_API_KEY,
+OPENAI_BASE_URL). The LLM cache is turned off so every bank pays for its
+calls. Token counts are estimated from prompt and response text.
+
+    python benchmarks/fused_vs_staged.py request.json --banks 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+os.environ["LLM_CACHE_MODE"] = "off"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ap_mcq_generation_api as api  # noqa: E402
+
+class CallCounter:
+    """Wraps call_openai_api to count calls and estimated tokens"""
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._call = api.call_openai_api
+
+    async def __call__(self, messages, *args, **kwargs):
+        self.calls += 1
+        self.prompt_tokens += sum(api.estimate_tokens(m["content"]) for m in messages)
+        response = await self._call(messages, *args, **kwargs)
+        self.completion_tokens += api.estimate_tokens(response or "")
+        return response
+
+async def run_mode(mode: str, request: "api.QuestionRequest", banks: int) -> dict:
+    api.GENERATION_MODE = mode
+    counter = CallCounter()
+    api.call_openai_api = counter
+    latencies = []
+    try:
+        for _ in range(banks):
+            started = time.perf_counter()
+            await api.run_question_bank_pipeline(request)
+            latencies.append(time.perf_counter() - started)
+    finally:
+        api.call_openai_api = counter._call
+    latencies.sort()
+    return {
+        "mode": mode,
+        "banks": banks,
+        "mean_s": statistics.mean(latencies),
+        "p95_s": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+        "calls_per_bank": counter.calls / banks,
+        "prompt_tokens_per_bank": counter.prompt_tokens / banks,
+        "completion_tokens_per_bank": counter.completion_tokens / banks,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("request", help="JSON file containing one QuestionRequest")
+    parser.add_argument("--banks", type=int, default=3, help="Banks generated per mode")
+    args = parser.parse_args()
+
+    with open(args.request) as f:
+        request = api.QuestionRequest(**json.load(f))
+
+    async def run_all():
+        # One event loop for both modes: the OpenAI client is bound to it
+        return [await run_mode(mode, request, args.banks) for mode in api.GENERATION_MODES]
+
+    results = asyncio.run(run_all())
+    print(f"{'mode':<8} {'mean s':>8} {'p95 s':>8} {'calls':>7} {'prompt tok':>11} {'completion tok':>15}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['mean_s']:>8.2f} {r['p95_s']:>8.2f} {r['calls_per_bank']:>7.1f} "
+              f"{r['prompt_tokens_per_bank']:>11.0f} {r['completion_tokens_per_bank']:>15.0f}")
+
+if __name__ == "__main__":
+    main()
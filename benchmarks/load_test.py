@@ -0,0 +1,200 @@
+"""Load-test /generate-questions against the local mock LLM server.
+
+Starts benchmarks/mock_llm_server.py (unless --llm-base-url points at a
+running backend), drives the API in-process at the given concurrency and
+reports throughput, latency percentiles, LLM calls per bank and the
+process's peak threads and memory. No network or OpenAI key is needed:
+
+    python benchmarks/load_test.py --requests 40 --concurrency 8 \\
+        --latency lognormal:0.5:0.5 --error-rate 0.02 --malformed-rate 0.02
+
+Use --target-url to drive a separately running API server over HTTP
+instead, and --output to save the report as JSON (e.g. for CI).
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+SAMPLE_REQUEST = {
+    "article": " ".join(
+        f"Paragraph {i}: cells regulate nutrients and signals across their membranes to "
+        f"maintain homeostasis, while enzymes convert glucose and oxygen to generate ATP."
+        for i in range(40)),
+    "current_question_bank": "Which organelle produces ATP?\nHow do enzymes lower activation energy?",
+    "ek_codes": "EK-1.A, EK-1.B",
+    "lo_codes": "LO-1.1, LO-1.2",
+}
+
+MOCK_OPTIONS = ("latency", "error_rate", "malformed_rate", "rate_limit_rate", "max_concurrency")
+
+def percentile(values, pct: float) -> float:
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    rank = max(1, min(len(ordered), round(pct / 100 * len(ordered) + 0.5)))
+    return ordered[rank - 1]
+
+def rss_mb() -> float:
+    """Current resident set size, falling back to the peak where /proc is missing"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+def start_mock_server(args) -> subprocess.Popen:
+    command = [sys.executable, os.path.join(BENCHMARKS_DIR, "mock_llm_server.py"),
+               "--port", str(args.mock_port)]
+    for option in MOCK_OPTIONS:
+        value = getattr(args, option)
+        if value is not None:
+            command += [f"--{option.replace('_', '-')}", str(value)]
+    server = subprocess.Popen(command)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{args.mock_port}/stats", timeout=1)
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("Mock LLM server did not start")
+
+async def run_load(client: httpx.AsyncClient, body: dict, requests: int,
+                   concurrency: int) -> dict:
+    latencies = []
+    statuses = {}
+    samples = {"threads": 0, "rss_mb": 0.0}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(number: int):
+        # Distinct bodies, so a server with request coalescing on still runs every bank
+        unique_body = {**body, "current_question_bank":
+                       f"{body['current_question_bank']}\nLoad test request {number}"}
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.post("/generate-questions", json=unique_body)
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == "200":
+                latencies.append(time.perf_counter() - started)
+
+    async def sample():
+        while True:
+            samples["threads"] = max(samples["threads"], threading.active_count())
+            samples["rss_mb"] = max(samples["rss_mb"], rss_mb())
+            await asyncio.sleep(0.2)
+
+    sampler = asyncio.ensure_future(sample())
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(one(number) for number in range(requests)))
+    finally:
+        sampler.cancel()
+    elapsed = time.perf_counter() - started
+    return {"elapsed_s": elapsed, "latencies": latencies, "statuses": statuses,
+            "peak_threads": samples["threads"], "peak_rss_mb": samples["rss_mb"]}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20, help="Total banks requested")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once")
+    parser.add_argument("--request", help="JSON file with the QuestionRequest to send "
+                                          "(default: a built-in sample)")
+    parser.add_argument("--target-url", help="Drive a running API server at this URL "
+                                             "instead of the app in-process")
+    parser.add_argument("--llm-base-url", help="Use this LLM backend instead of "
+                                               "starting the mock server")
+    parser.add_argument("--mock-port", type=int, default=8100)
+    parser.add_argument("--latency", help="Mock latency: fixed:S, uniform:LOW:HIGH "
+                                          "or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--error-rate", type=float)
+    parser.add_argument("--malformed-rate", type=float)
+    parser.add_argument("--rate-limit-rate", type=float)
+    parser.add_argument("--max-concurrency", type=int)
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    body = SAMPLE_REQUEST
+    if args.request:
+        with open(args.request) as f:
+            body = json.load(f)
+
+    server = None
+    llm_base_url = args.llm_base_url
+    if llm_base_url is None:
+        server = start_mock_server(args)
+        llm_base_url = f"http://127.0.0.1:{args.mock_port}/v1"
+    stats_url = llm_base_url.rsplit("/v1", 1)[0] + "/stats" if server else None
+
+    # Configure the in-process app before importing it
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    os.environ["LLM_BASE_URL"] = llm_base_url
+    os.environ["LLM_CACHE_MODE"] = "off"
+    os.environ["REQUEST_COALESCING"] = "0"
+    try:
+        if stats_url:
+            httpx.post(f"{stats_url}/reset")
+
+        async def run():
+            if args.target_url:
+                client = httpx.AsyncClient(base_url=args.target_url, timeout=None)
+            else:
+                import ap_mcq_generation_api as api
+                client = httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app),
+                                           base_url="http://api", timeout=None)
+            async with client:
+                return await run_load(client, body, args.requests, args.concurrency)
+
+        result = asyncio.run(run())
+        backend = httpx.get(stats_url).json() if stats_url else {}
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latencies = result["latencies"]
+    completed = len(latencies)
+    report = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "completed": completed,
+        "statuses": result["statuses"],
+        "elapsed_s": round(result["elapsed_s"], 3),
+        "requests_per_s": round(completed / result["elapsed_s"], 3),
+        "p50_s": round(percentile(latencies, 50), 3) if latencies else None,
+        "p95_s": round(percentile(latencies, 95), 3) if latencies else None,
+        "p99_s": round(percentile(latencies, 99), 3) if latencies else None,
+        "llm_calls_per_bank": (round(backend.get("calls", 0) / completed, 2)
+                               if backend and completed else None),
+        "backend": backend,
+        "peak_threads": result["peak_threads"],
+        "peak_rss_mb": round(max(result["peak_rss_mb"], peak_rss_mb()), 1),
+    }
+    if args.target_url:
+        # Threads and memory of this driver, not of the remote server
+        report["measured_process"] = "load generator"
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""Local stand-in for the OpenAI chat completions API, for offline benchmarks.
+
+Answers every prompt type the generator sends (question sets, correct
+answers, distractor sets, single distractors, explanations and fused
+options) with schema-valid JSON whose options pass the mechanical checks.
+Latency, server errors, malformed JSON and 429s are configurable:
+
+    python benchmarks/mock_llm_server.py --port 8100 --latency lognormal:2:0.6 \\
+        --error-rate 0.01 --malformed-rate 0.02 --rate-limit-rate 0.01 --max-concurrency 64
+
+Point the API at it with LLM_BASE_URL=http://127.0.0.1:8100/v1. GET /stats
+returns call, fault-injection and prompt-cache counters; POST /stats/reset
+clears them. Like the real API, it reports a system message it has seen
+before (of at least 1024 tokens) as cached prompt tokens.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import uuid
+from collections import Counter
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+SCHEMA_MARKER = "Please output your response in this exact JSON format"
+
+# Prefix caching: minimum cacheable prefix and the step cache hits grow in
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP_TOKENS = 128
+PROMPT_CACHE_SIZE = 10000
+
+# Reasoning effort scales latency and reasoning tokens
+EFFORT_SCALE = {"low": 0.35, "medium": 0.65, "high": 1.0}
+REASONING_TOKENS = {"low": 250, "medium": 900, "high": 2500}
+
+# Topic words for generated text; none of them are absolute words
+SUBJECTS = ["cells", "enzymes", "plants", "neurons", "bacteria", "proteins", "membranes",
+            "ribosomes", "hormones", "fungi", "mitochondria", "chloroplasts", "genes",
+            "antibodies", "viruses", "tissues", "organisms", "populations", "ecosystems"]
+VERBS = ["use", "convert", "regulate", "transport", "store", "release", "absorb",
+         "produce", "signal", "bind", "modify", "sense", "degrade", "copy"]
+OBJECTS = ["glucose", "oxygen", "water", "nutrients", "signals", "ions", "amino acids",
+           "light energy", "nitrogen", "carbon dioxide", "lipids", "nucleotides", "heat",
+           "electrons", "waste products", "growth factors"]
+PURPOSES = ["to maintain homeostasis", "to power active transport", "to build new tissue",
+            "to respond to stress", "to support cell division", "to defend against infection",
+            "to coordinate growth", "to recycle materials", "to generate ATP",
+            "to control gene expression"]
+PLACES = ["across their membranes", "inside the nucleus", "within the cytoplasm",
+          "near the cell surface", "throughout the organism", "in the bloodstream",
+          "along the root system", "between neighboring cells"]
+TASK_VERBS = ["explain", "describe", "identify", "compare", "predict", "justify"]
+
+def parse_latency(spec: str):
+    """fixed:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA (seconds)"""
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise argparse.ArgumentTypeError(
+        f"Invalid latency {spec!r}; use fixed:S, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+
+class MockConfig:
+    def __init__(self):
+        self.latency = parse_latency("uniform:0.05:0.15")
+        self.error_rate = 0.0
+        self.malformed_rate = 0.0
+        self.rate_limit_rate = 0.0
+        self.max_concurrency = 0  # 0 = unlimited
+        self.retry_after_ms = 500
+
+config = MockConfig()
+counters: Counter = Counter()
+in_flight = 0
+seen_prefixes: dict = {}
+
+def sentence() -> str:
+    return (f"{random.choice(SUBJECTS).capitalize()} {random.choice(VERBS)} "
+            f"{random.choice(OBJECTS)} {random.choice(PURPOSES)} {random.choice(PLACES)}.")
+
+def rewrite(correct: str, used: set) -> str:
+    """A wrong option with the same word count and commas as the correct one"""
+    words = correct.rstrip(".").split()
+    for _ in range(50):
+        candidate = list(words)
+        for i in random.sample(range(len(words)), k=min(3, len(words))):
+            if "," not in candidate[i]:
+                pool = SUBJECTS + VERBS + [w for o in OBJECTS for w in o.split()]
+                candidate[i] = random.choice(pool)
+        text = " ".join(candidate) + "."
+        text = text[0].upper() + text[1:]
+        if text.lower() not in used:
+            used.add(text.lower())
+            return text
+    return correct
+
+def tagged(prompt: str, tag: str) -> str:
+    """The last <tag>...</tag> value; instructions may mention <tag> in prose"""
+    end = prompt.rfind(f"</{tag}>")
+    start = prompt.rfind(f"<{tag}>", 0, end)
+    return prompt[start + len(tag) + 2:end].strip() if start >= 0 else ""
+
+def explanations() -> dict:
+    return {
+        "correct_answer_explanation":
+            f"This answer is correct. You previously learned that {sentence().lower()}",
+        "distractor_explanations": {
+            key: {"explanation": f"This answer is incorrect. You previously learned that "
+                                 f"{sentence().lower()}"}
+            for key in ("d1", "d2", "d3")
+        },
+    }
+
+def distractors(correct: str) -> dict:
+    used = {correct.lower()}
+    return {key: {"response_text": rewrite(correct, used)} for key in ("d1", "d2", "d3")}
+
+def respond(prompt: str) -> dict:
+    """Fill in the JSON schema that follows SCHEMA_MARKER in the prompt"""
+    text = prompt.split(SCHEMA_MARKER)[-1].split("\n", 1)[1]
+    schema, _ = json.JSONDecoder().raw_decode(text.lstrip())
+    if "questions" in schema:
+        match = re.search(r"difficulty: (\d)", prompt)
+        difficulty = int(match.group(1)) if match else 1
+        match = re.search(r"exactly (\d+) questions", prompt)
+        count = int(match.group(1)) if match else len(schema["questions"])
+        return {"questions": [
+            {
+                "question_number": i,
+                "question_text": f"How do {random.choice(SUBJECTS)} {random.choice(VERBS)} "
+                                 f"{random.choice(OBJECTS)} {random.choice(PURPOSES)} "
+                                 f"{random.choice(PLACES)} ({uuid.uuid4().hex[:6]})?",
+                "ek_code_specific_to_this_question": tagged(prompt, "ek").split(",")[0] or "EK",
+                "lo_code_specific_to_this_question": tagged(prompt, "lo").split(",")[0] or "LO",
+                "task_verb": random.choice(TASK_VERBS),
+                "difficulty": difficulty,
+            }
+            for i in range(1, count + 1)]}
+    if "distractor" in schema:
+        correct = tagged(prompt, "correct")
+        return {"distractor": {"response_text": rewrite(correct, {correct.lower()})}}
+    response = {}
+    correct = tagged(prompt, "correct")
+    if "correct_answer" in schema:
+        correct = sentence()
+        response["correct_answer"] = {"response_text": correct}
+    if "distractors" in schema:
+        response["distractors"] = distractors(correct)
+    if "explanations" in schema:
+        response["explanations"] = explanations()
+    return response
+
+def cached_tokens(messages: list) -> int:
+    """Prompt tokens a real prefix cache would serve: the system message, once
+    seen, rounded down to PROMPT_CACHE_STEP_TOKENS"""
+    if len(messages) < 2 or messages[0]["role"] != "system":
+        return 0
+    prefix = messages[0]["content"]
+    tokens = len(prefix) // 4
+    if tokens < PROMPT_CACHE_MIN_TOKENS:
+        return 0
+    if prefix not in seen_prefixes:
+        if len(seen_prefixes) >= PROMPT_CACHE_SIZE:
+            seen_prefixes.pop(next(iter(seen_prefixes)))
+        seen_prefixes[prefix] = True
+        return 0
+    return tokens - tokens % PROMPT_CACHE_STEP_TOKENS
+
+app = FastAPI()
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    global in_flight
+    body = await request.json()
+    prompt = "\n".join(m["content"] for m in body["messages"])
+    effort = body.get("reasoning_effort") or "medium"
+    counters["calls"] += 1
+
+    over_capacity = config.max_concurrency and in_flight >= config.max_concurrency
+    if over_capacity or random.random() < config.rate_limit_rate:
+        counters["rate_limited"] += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached", "type": "requests",
+                       "code": "rate_limit_exceeded"}},
+            status_code=429, headers={"retry-after-ms": str(config.retry_after_ms)})
+
+    in_flight += 1
+    counters["peak_in_flight"] = max(counters["peak_in_flight"], in_flight)
+    try:
+        await asyncio.sleep(config.latency() * EFFORT_SCALE.get(effort, 1.0))
+    finally:
+        in_flight -= 1
+
+    if random.random() < config.error_rate:
+        counters["server_errors"] += 1
+        return JSONResponse({"error": {"message": "The server had an error", "type": "server_error"}},
+                            status_code=500)
+
+    content = json.dumps(respond(prompt))
+    if random.random() < config.malformed_rate:
+        counters["malformed"] += 1
+        content = content[:len(content) // 2]
+    counters["completed"] += 1
+
+    prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 4
+    cached = cached_tokens(body["messages"])
+    counters["prompt_tokens"] += prompt_tokens
+    counters["cached_prompt_tokens"] += cached
+    completion_tokens = len(content) // 4
+    reasoning_tokens = int(REASONING_TOKENS.get(effort, 900) * random.uniform(0.5, 1.5))
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": content}}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens + reasoning_tokens,
+            "total_tokens": prompt_tokens + completion_tokens + reasoning_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached},
+            "completion_tokens_details": {"reasoning_tokens": reasoning_tokens},
+        },
+    }
+
+@app.get("/stats")
+def stats():
+    return {**counters, "in_flight": in_flight}
+
+@app.post("/stats/reset")
+def reset_stats():
+    counters.clear()
+    seen_prefixes.clear()
+    return stats()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=parse_latency, default=config.latency,
+                        help="Latency of a high-effort call: fixed:S, uniform:LOW:HIGH or "
+                             "lognormal:MEDIAN:SIGMA (default uniform:0.05:0.15)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Share of calls answered with a 500")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="Share of calls answered with truncated JSON")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Share of calls answered with a 429")
+    parser.add_argument("--max-concurrency", type=int, default=0,
+                        help="Answer with a 429 above this many in-flight calls (0 = no limit)")
+    parser.add_argument("--retry-after-ms", type=int, default=500,
+                        help="retry-after-ms header sent with 429s")
+    args = parser.parse_args()
+
+    config.latency = args.latency
+    config.error_rate = args.error_rate
+    config.malformed_rate = args.malformed_rate
+    config.rate_limit_rate = args.rate_limit_rate
+    config.max_concurrency = args.max_concurrency
+    config.retry_after_ms = args.retry_after_ms
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
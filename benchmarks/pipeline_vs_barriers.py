@@ -0,0 +1,99 @@
+"""Simulate stage-barrier and per-question pipeline ordering at the same concurrency.
+
+Each bank writes a question set per difficulty, then for every question a
+correct answer, distractors and explanations. Call latencies are drawn
+from a lognormal distribution, once per call, so both orderings see exactly
+the same calls; the only difference is when each call may start:
+
+- barriers: every question clears a stage before any question starts the next
+- pipeline: each question starts its next stage as soon as its own finishes
+
+Both run under the same cap on concurrent calls. No API key or network is
+needed; simulated time is compressed by --time-scale:
+
+    python benchmarks/pipeline_vs_barriers.py --banks 20 --concurrency 3 9
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import statistics
+import time
+
+DIFFICULTIES = (1, 2, 3)
+QUESTION_STAGES = ("correct_answer", "distractors", "explanations")
+
+def draw_latencies(rng: random.Random, questions_per_difficulty: int,
+                   median: float, sigma: float) -> dict:
+    """Latency of every call in one bank, keyed by (stage, difficulty, question)"""
+    def draw():
+        return rng.lognormvariate(math.log(median), sigma)
+    latencies = {("question_set", d, None): draw() for d in DIFFICULTIES}
+    for d in DIFFICULTIES:
+        for q in range(questions_per_difficulty):
+            for stage in QUESTION_STAGES:
+                latencies[(stage, d, q)] = draw()
+    return latencies
+
+async def run_bank(ordering: str, latencies: dict, questions_per_difficulty: int,
+                   concurrency: int, time_scale: float) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(key):
+        async with semaphore:
+            await asyncio.sleep(latencies[key] * time_scale)
+
+    questions = [(d, q) for d in DIFFICULTIES for q in range(questions_per_difficulty)]
+    started = time.perf_counter()
+    if ordering == "barriers":
+        await asyncio.gather(*(call(("question_set", d, None)) for d in DIFFICULTIES))
+        for stage in QUESTION_STAGES:
+            await asyncio.gather(*(call((stage, d, q)) for d, q in questions))
+    else:
+        async def chain(d, q):
+            for stage in QUESTION_STAGES:
+                await call((stage, d, q))
+
+        async def difficulty(d):
+            await call(("question_set", d, None))
+            await asyncio.gather(*(chain(d, q) for q in range(questions_per_difficulty)))
+
+        await asyncio.gather(*(difficulty(d) for d in DIFFICULTIES))
+    return (time.perf_counter() - started) / time_scale
+
+def summarize(times) -> dict:
+    ordered = sorted(times)
+    p95 = ordered[max(0, math.ceil(0.95 * len(ordered)) - 1)]
+    return {"mean_s": round(statistics.mean(times), 2), "p95_s": round(p95, 2)}
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--banks", type=int, default=20)
+    parser.add_argument("--questions-per-difficulty", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[3, 9],
+                        help="Caps on concurrent calls to compare (both orderings use each)")
+    parser.add_argument("--median", type=float, default=0.3,
+                        help="Median call latency in simulated seconds")
+    parser.add_argument("--sigma", type=float, default=0.6, help="Lognormal sigma")
+    parser.add_argument("--time-scale", type=float, default=0.1,
+                        help="Wall seconds per simulated second")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    banks = [draw_latencies(rng, args.questions_per_difficulty, args.median, args.sigma)
+             for _ in range(args.banks)]
+    report = []
+    for concurrency in args.concurrency:
+        row = {"concurrency": concurrency}
+        for ordering in ("barriers", "pipeline"):
+            times = [await run_bank(ordering, latencies, args.questions_per_difficulty,
+                                    concurrency, args.time_scale)
+                     for latencies in banks]
+            row[ordering] = summarize(times)
+        report.append(row)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("LLM_CACHE_MODE", "off")
+
+from ap_mcq_generation_api import AdaptiveConcurrencyController  # noqa: E402
+
+
+def test_cancelled_paused_acquire_releases_its_slot():
+    async def run():
+        controller = AdaptiveConcurrencyController(initial=1, minimum=1, maximum=4)
+        controller.paused_until = time.monotonic() + 60
+        task = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0.01)
+        assert controller.in_flight == 1
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert controller.in_flight == 0
+
+        # The freed slot can be taken again once the pause is over
+        controller.paused_until = 0.0
+        await asyncio.wait_for(controller.acquire(), timeout=1)
+        assert controller.in_flight == 1
+
+    asyncio.run(run())
+
+
+def test_cancelled_paused_acquire_hands_slot_to_queued_call():
+    async def run():
+        controller = AdaptiveConcurrencyController(initial=1, minimum=1, maximum=4)
+        controller.paused_until = time.monotonic() + 0.2
+        paused = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0.01)
+        queued = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0.01)
+        assert controller.queue_depth == 1
+        paused.cancel()
+        await asyncio.wait_for(queued, timeout=1)
+        assert controller.in_flight == 1
+        assert controller.queue_depth == 0
+
+    asyncio.run(run())
@@ -0,0 +1,201 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from pydantic import BaseModel
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("LLM_CACHE_MODE", "off")
+
+import ap_mcq_generation_api as api  # noqa: E402
+from ap_mcq_generation_api import (  # noqa: E402
+    LLMCallError,
+    Question,
+    QuestionRequest,
+    RetryBudget,
+    call_llm_json,
+    current_retry_budget,
+    generate_mcq_chain_with_recovery,
+    parse_llm_json,
+    repair_llm_json,
+)
+
+
+class Answer(BaseModel):
+    answer: str
+
+
+VALID = '{"answer": "Enzymes lower activation energy."}'
+MESSAGES = [{"role": "user", "content": "Answer the question."}]
+QUESTION = Question(question_number=1, question_text="What do enzymes do?",
+                    ek_code_specific_to_this_question="EK 1",
+                    lo_code_specific_to_this_question="LO 1",
+                    task_verb="Describe", difficulty=1)
+REQUEST = QuestionRequest(article="Enzymes speed up reactions.", current_question_bank="",
+                          ek_codes="EK 1", lo_codes="LO 1")
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(api, "LLM_CACHE_MODE", "off")
+    monkeypatch.setattr(api, "retry_delay", lambda attempt: 0)
+    monkeypatch.setattr(api, "LLM_MAX_ATTEMPTS", 3)
+
+
+def fake_openai(monkeypatch, responses):
+    """Answer OpenAI calls from responses in order: text, None or an exception"""
+    calls = []
+
+    async def call_openai_hedged(messages, model, reasoning_effort, stage, difficulty, tier):
+        response = responses[len(calls)]
+        calls.append(tier)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(api, "call_openai_hedged", call_openai_hedged)
+    return calls
+
+
+def run_with_budget(coroutine, retries):
+    async def run():
+        current_retry_budget.set(RetryBudget(retries))
+        return await coroutine
+    return asyncio.run(run())
+
+
+def test_repair_strips_code_fences():
+    assert repair_llm_json(f"```json\n{VALID}\n```") == VALID
+    assert repair_llm_json(f"```\n{VALID}\n```") == VALID
+
+
+def test_repair_extracts_object_from_prose():
+    text = f"Here is the answer you asked for:\n{VALID}\nLet me know if you need more."
+    assert repair_llm_json(text) == VALID
+
+
+def test_repair_ignores_braces_inside_strings():
+    text = 'Sure: {"answer": "Use {braces} and \\"quotes\\"."} Done.'
+    assert repair_llm_json(text) == '{"answer": "Use {braces} and \\"quotes\\"."}'
+
+
+def test_parse_repairs_wrapped_json():
+    parsed, text = parse_llm_json(f"```json\n{VALID}\n```", Answer)
+    assert parsed.answer == "Enzymes lower activation energy."
+    assert text == VALID
+    parsed, _ = parse_llm_json(f"The JSON is {VALID}.", Answer)
+    assert parsed.answer == "Enzymes lower activation energy."
+
+
+def test_parse_rejects_unusable_output():
+    with pytest.raises(ValueError):
+        parse_llm_json(None, Answer)
+    with pytest.raises(ValueError):
+        parse_llm_json('{"answer": "cut off', Answer)
+    with pytest.raises(ValueError):
+        parse_llm_json("[1, 2]", Answer)
+    with pytest.raises(ValueError):
+        parse_llm_json('{"reply": "wrong field"}', Answer)
+
+
+def test_no_content_is_retried_one_tier_up(monkeypatch):
+    calls = fake_openai(monkeypatch, [None, VALID])
+    parsed = run_with_budget(call_llm_json(MESSAGES, Answer, stage="correct_answer",
+                                           difficulty=1), retries=5)
+    assert parsed.answer == "Enzymes lower activation energy."
+    assert len(calls) == 2
+    tiers = list(api.LLM_TIERS)
+    assert tiers.index(calls[1]) == min(tiers.index(calls[0]) + 1, len(tiers) - 1)
+
+
+def test_non_retryable_error_fails_immediately(monkeypatch):
+    calls = fake_openai(monkeypatch, [LLMCallError("bad request", retryable=False), VALID])
+    budget = RetryBudget(5)
+
+    async def run():
+        current_retry_budget.set(budget)
+        return await call_llm_json(MESSAGES, Answer)
+
+    with pytest.raises(LLMCallError):
+        asyncio.run(run())
+    assert len(calls) == 1
+    assert budget.remaining == 5
+
+
+def test_retryable_error_spends_budget(monkeypatch):
+    calls = fake_openai(monkeypatch, [LLMCallError("overloaded", retryable=True), VALID])
+    budget = RetryBudget(5)
+
+    async def run():
+        current_retry_budget.set(budget)
+        return await call_llm_json(MESSAGES, Answer)
+
+    assert asyncio.run(run()).answer == "Enzymes lower activation energy."
+    assert len(calls) == 2
+    assert budget.remaining == 4
+
+
+def test_call_fails_when_budget_runs_out(monkeypatch):
+    calls = fake_openai(monkeypatch, ["not json", "not json", VALID])
+    with pytest.raises(ValueError):
+        run_with_budget(call_llm_json(MESSAGES, Answer), retries=1)
+    # One retry was allowed, so the third (valid) response is never requested
+    assert len(calls) == 2
+
+
+def test_call_fails_after_max_attempts(monkeypatch):
+    calls = fake_openai(monkeypatch, ["not json"] * 5)
+    with pytest.raises(ValueError):
+        run_with_budget(call_llm_json(MESSAGES, Answer), retries=10)
+    assert len(calls) == 3
+
+
+def fake_chain(monkeypatch, outcomes):
+    """Make generate_mcq_chain fail with each exception in outcomes, then succeed"""
+    attempts = []
+
+    async def generate_mcq_chain(question, request_data, on_event=None, checkpoint=None):
+        attempts.append(question.question_number)
+        if len(attempts) <= len(outcomes):
+            raise outcomes[len(attempts) - 1]
+        return "mcq"
+
+    monkeypatch.setattr(api, "generate_mcq_chain", generate_mcq_chain)
+    return attempts
+
+
+def test_chain_is_regenerated_within_budget(monkeypatch):
+    attempts = fake_chain(monkeypatch, [ValueError("bad"),
+                                        LLMCallError("overloaded", retryable=True)])
+    budget = RetryBudget(2)
+
+    async def run():
+        current_retry_budget.set(budget)
+        return await generate_mcq_chain_with_recovery(QUESTION, REQUEST)
+
+    assert asyncio.run(run()) == "mcq"
+    assert len(attempts) == 3
+    assert budget.remaining == 0
+
+
+def test_chain_fails_when_budget_runs_out(monkeypatch):
+    attempts = fake_chain(monkeypatch, [ValueError("bad")] * 3)
+    with pytest.raises(ValueError):
+        run_with_budget(generate_mcq_chain_with_recovery(QUESTION, REQUEST), retries=1)
+    assert len(attempts) == 2
+
+
+def test_chain_does_not_retry_non_retryable_errors(monkeypatch):
+    attempts = fake_chain(monkeypatch, [LLMCallError("bad request", retryable=False)])
+    budget = RetryBudget(5)
+
+    async def run():
+        current_retry_budget.set(budget)
+        return await generate_mcq_chain_with_recovery(QUESTION, REQUEST)
+
+    with pytest.raises(LLMCallError):
+        asyncio.run(run())
+    assert len(attempts) == 1
+    assert budget.remaining == 5
@@ -0,0 +1,102 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("LLM_CACHE_MODE", "off")
+
+from ap_mcq_generation_api import (  # noqa: E402
+    MAX_OPTION_WORDS,
+    DistractorResponse,
+    Distractors,
+    count_sentences,
+    validate_correct_answer,
+    validate_distractors,
+)
+
+CORRECT = "Enzymes lower the activation energy of reactions in cells."
+
+
+def distractors(d1, d2="Cells store glucose as starch in their membranes.",
+                d3="Proteins carry oxygen through the plant cell wall."):
+    return Distractors(d1=DistractorResponse(response_text=d1),
+                       d2=DistractorResponse(response_text=d2),
+                       d3=DistractorResponse(response_text=d3))
+
+
+def rules(violations, option=None):
+    return sorted(v.rule for v in violations if option is None or v.option == option)
+
+
+def test_valid_options_pass():
+    assert validate_correct_answer(CORRECT) == []
+    assert validate_distractors(
+        CORRECT, distractors("Enzymes raise the activation energy of reactions in cells.")) == []
+
+
+def test_single_sentence():
+    assert rules(validate_correct_answer("Enzymes lower energy. Cells use them.")) == [
+        "single_sentence"]
+    assert rules(validate_correct_answer("Enzymes lower energy! Cells use them.")) == [
+        "single_sentence"]
+    violations = validate_distractors(CORRECT, distractors("Enzymes raise energy. Cells stop them."))
+    assert "single_sentence" in rules(violations, "d1")
+
+
+def test_abbreviations_do_not_break_sentences():
+    assert validate_correct_answer("The U.S. Congress funds NIH research on cells.") == []
+    assert validate_correct_answer(
+        "Some enzymes, e.g. Salivary amylase, break down starch.") == []
+    assert validate_correct_answer("Dr. Smith showed that cells divide by mitosis.") == []
+    assert validate_correct_answer("Plants, i.e. Producers, make their own glucose.") == []
+    assert count_sentences("Cells need water, salts, etc. To grow.") == 1
+
+
+def test_initials_do_not_break_sentences_but_words_do():
+    assert count_sentences("J. Watson described the structure of DNA.") == 1
+    assert count_sentences("Cells divide. 3 cells remain.") == 2
+    assert count_sentences("Cells divide. \"Then\" they grow.") == 2
+
+
+def test_max_words():
+    too_long = " ".join(["cells"] * (MAX_OPTION_WORDS + 1)) + "."
+    assert rules(validate_correct_answer(too_long)) == ["max_words"]
+    assert validate_correct_answer(" ".join(["cells"] * MAX_OPTION_WORDS) + ".") == []
+
+
+def test_absolutes():
+    violations = validate_distractors(
+        CORRECT, distractors("Enzymes always raise the activation energy in cells."))
+    assert rules(violations, "d1") == ["absolutes"]
+    assert "always" in violations[0].message
+
+
+def test_absolutes_match_whole_words_only():
+    # "allele" contains "all" but is not an absolute
+    assert validate_distractors(
+        CORRECT, distractors("Enzymes copy each allele of a gene in cells.")) == []
+
+
+def test_length_must_be_close_to_correct_answer():
+    violations = validate_distractors(CORRECT, distractors("Enzymes raise energy."))
+    assert rules(violations, "d1") == ["length"]
+    # Within MAX_DISTRACTOR_WORD_DIFF words either way is fine
+    assert validate_distractors(
+        CORRECT, distractors("Enzymes raise the activation energy in cells.")) == []
+
+
+def test_commas_must_match_correct_answer():
+    violations = validate_distractors(
+        CORRECT, distractors("Enzymes, in cells, raise the activation energy of reactions."))
+    assert rules(violations, "d1") == ["commas"]
+
+
+def test_distinct_options():
+    violations = validate_distractors(
+        CORRECT, distractors("enzymes lower the activation energy of reactions in cells"))
+    assert rules(violations, "d1") == ["distinct"]
+    same = "Cells store glucose as starch in their membranes."
+    violations = validate_distractors(CORRECT, distractors(
+        "Enzymes raise the activation energy of reactions in cells.", same, same))
+    assert rules(violations, "d3") == ["distinct"]
+    assert rules(violations, "d2") == []